@@ -8,16 +8,29 @@ Date: 28-02-2019
 Add variant statistics from bam file to vcf.
 Works on both germline and somatic variants.
 Users are advised to run mpileup tools to generate mpileup file. 
+Alternatively the indexed bam/cram files can be read directly with pysam
+(--bam, or --normal_bam and --tumor_bam, with --reference), piling up the
+reads at the vcf positions only.
+Multi-sample vcfs (e.g. trios and cohorts) are annotated in one pass with
+--type multisample and a --sample id pileup pair for each sample to annotate.
+With --jobs, blocks of variants are annotated in parallel processes, and
+written in the input order.
+The vcf and mpileup files can be plain text or gzip/bgzip compressed. An output
+name ending with .gz is written bgzipped (and indexed with --index).
 An example to run:
 samtools mpileup -A -B -Q 0 -d 10000 -l regions.tsv -f reference.fa bam_file > mpileup_file
 """
 
 ###############################################################################
 
-import re
 import argparse
+import multiprocessing
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from variant import Variant, BAM_STATS_LINES
+from vcfio import INDEX_FORMATS, open_vcf, ordered_map
+from vcfheader import ContigOrder, contig_id
+from pileup import BamPileup, MpileupStream, tokenize_pileups
 
 
 ###############################################################################
@@ -31,18 +44,102 @@ def create_mpileup_dict(mpileup):
     except:
         sys.exit('Failed to open file {}'.format(mpileup))
     mpileup_dict = {}
-    with open(mpileup, 'r') as f:
+    with open_vcf(mpileup) as f:
         for line in f:
             line = line.split()
-            # clean up the start or end of read from mpileup line
-            line[4] = re.sub(r'(\^.|\$)', '', line[4])
             mpileup_dict.update({'\t'.join(line[:2]): line[3:5]})
     return mpileup_dict
 
+
+def mpileup_lookup(mpileup, contig_order=None):
+    """Get the function returning the mpileup [depth, bases] at (chr, pos)
+    If contig_order is given, the mpileup is streamed in step with the sorted
+    vcf, otherwise it is read into a dictionary
+    """
+    if contig_order is not None:
+        return MpileupStream(mpileup, contig_order).get
+    mpileup_dict = create_mpileup_dict(mpileup)
+    return lambda chrom, pos: mpileup_dict.get('\t'.join([chrom, pos]), '')
+
+
+def pileup_lookup(mpileup, bam, reference, contig_order=None):
+    """Get the function returning the [depth, bases] at (chr, pos), from the
+    bam if given, otherwise from the mpileup
+    """
+    if bam:
+        return BamPileup(bam, reference).get
+    return mpileup_lookup(mpileup, contig_order)
+
+
+def is_bam(pileup):
+    """Whether the --sample pileup is a bam/cram (otherwise an mpileup)
+    """
+    return pileup.endswith(('.bam', '.cram'))
+
+
+def annotate_variant(line, pileups, vcf_type, columns=None, tokens=None):
+    """Add the bam stats to the variant line
+    Input: the pileup ([depth, bases] or '') of each sample to annotate,
+           columns are the (normal, tumor) indexes if somatic, or the pileup
+           index of each sample column (None if not annotated) if multisample,
+           tokens are the {bases: tokens} of the pileups already tokenized
+    Output: the annotated variant line
+    """
+    if tokens is None:
+        tokens = {}
+    if vcf_type == 'germline':
+        variant = Variant().read_variant(line)
+    elif vcf_type == 'somatic':
+        variant = Variant().read_variant(line, somatic=True,
+                                         normal=columns[0],
+                                         tumor=columns[1])
+    else:
+        variant = Variant().read_variant(line, samples=True)
+    bam_stats = [variant.cal_bam_stats(pileup,
+                                       tokens.get(pileup[1]) if pileup
+                                       else None)
+                 for pileup in pileups]
+
+    if vcf_type == 'germline':
+        return variant.add_bam_stats(bam_stats[0]).write()
+    elif vcf_type == 'somatic':
+        variant = variant.add_bam_stats(bam_stats, somatic=True)
+        return variant.write(somatic=True)
+    bam_stats = [None if i is None else bam_stats[i] for i in columns]
+    return variant.add_samples_bam_stats(bam_stats).write()
+
+
+def annotate_block(job):
+    """Annotate a block of variants, in a worker process with --jobs
+    The pileups of the block are tokenized together (see tokenize_pileups)
+    Input: ([(line, pileups)], vcf_type, columns)
+    Output: the annotated lines, joined
+    """
+    block, vcf_type, columns = job
+    tokens = tokenize_pileups([pileup[1] for _, pileups in block
+                               for pileup in pileups if pileup])
+    return ''.join(annotate_variant(line, pileups, vcf_type, columns, tokens)
+                   for line, pileups in block)
+
+
+def pileup_blocks(lines, lookups, block_size):
+    """Split the variant lines into blocks of (line, pileups), the pileups are
+    looked up here, in the order of the vcf (so the mpileups can be streamed)
+    """
+    block = []
+    for line in lines:
+        chrom, pos = line.split('\t', 2)[:2]
+        block.append((line, [get_pileup(chrom, pos) for get_pileup in lookups]))
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
 ###############################################################################
 
 # Building API
-recognised_modes = ["germline", "somatic"]
+recognised_modes = ["germline", "somatic", "multisample"]
 
 # required and optional arguments
 parser = argparse.ArgumentParser(description='Get stats from bam file and \
@@ -51,7 +148,8 @@ optional = parser._action_groups.pop()
 required = parser.add_argument_group('required arguments')
 required.add_argument("-i",  help="input vcf", required=True)
 required.add_argument("-o", help="output vcf", required=True)
-required.add_argument("--type", help="must be either germline or somatic",
+required.add_argument("--type", help="must be either germline, somatic or \
+                      multisample",
                       required=True, choices=recognised_modes)
 parser._action_groups.append(optional)
 required.add_argument("--mpileup", help="mpileup file extracted from bam \
@@ -64,6 +162,30 @@ required.add_argument("--normal_id", help="Normal sample id, \
                       required if input is somatic vcf", required=False)
 required.add_argument("--tumor_id", help="Tumor sample id, \
                       required if input is somatic vcf", required=False)
+required.add_argument("--bam", help="indexed bam/cram file, read with pysam \
+                      instead of the mpileup file", required=False)
+required.add_argument("--normal_bam", help="indexed bam/cram file of the normal \
+                      sample, instead of the normal mpileup", required=False)
+required.add_argument("--tumor_bam", help="indexed bam/cram file of the tumor \
+                      sample, instead of the tumor mpileup", required=False)
+required.add_argument("--sample", help="sample id and its mpileup (or \
+                      bam/cram) file, required (once for each sample to \
+                      annotate) if input is multisample vcf", nargs=2,
+                      metavar=('SAMPLE_ID', 'PILEUP'), action='append',
+                      default=[])
+required.add_argument("--reference", help="reference fasta (with .fai), \
+                      required with the bam/cram files", required=False)
+optional.add_argument("--sorted-inputs", help="The vcf and mpileup files are \
+                      sorted by coordinate, in the ##contig order of the vcf. \
+                      Stream the mpileup files along the vcf instead of \
+                      reading them into memory", action="store_true")
+optional.add_argument("--jobs", help="Number of processes annotating the \
+                      variants (default: 1)", type=int, default=1)
+optional.add_argument("--block-size", help="Number of variants annotated in \
+                      each block with --jobs (default: 1000)", type=int,
+                      default=1000)
+optional.add_argument("--index", help="Index the output vcf, which is bgzipped \
+                      if the name ends with .gz", choices=INDEX_FORMATS)
 args = parser.parse_args()
 
 # Input sanity check
@@ -71,29 +193,50 @@ try:
     f = open(args.i, 'r')
 except:
     sys.exit('Failed to open file {}'.format(args.i))
+if (args.bam or args.normal_bam or args.tumor_bam or
+        any(is_bam(pileup) for _, pileup in args.sample)) and \
+        not args.reference:
+    sys.exit('reference fasta is required with the bam/cram files')
 if args.type == 'germline':
     try:
-        f = open(args.mpileup, 'r')
+        f = open(args.bam or args.mpileup, 'r')
     except:
-        sys.exit('Failed to open file {}'.format(args.mpileup))
+        sys.exit('Failed to open file {}'.format(args.bam or args.mpileup))
 elif args.type == 'somatic':
-    if not args.normal_mpileup:
+    if not (args.normal_mpileup or args.normal_bam):
         sys.exit('normal mpileup file is required for somatic vcf')
-    elif not args.tumor_mpileup:
+    elif not (args.tumor_mpileup or args.tumor_bam):
         sys.exit('tumor mpileup file is required for somatic vcf')
     elif not args.normal_id:
         sys.exit('normal sample id is required for somatic vcf')
     elif not args.tumor_id:
-        sys.exist('tumor sample id is required for somatic vcf')
+        sys.exit('tumor sample id is required for somatic vcf')
     else:
         try:
-            f = open(args.normal_mpileup, 'r')
+            f = open(args.normal_bam or args.normal_mpileup, 'r')
         except:
-            sys.exit('Failed to open file {}'.format(args.normal_mpileup))
+            sys.exit('Failed to open file {}'.format(
+                args.normal_bam or args.normal_mpileup))
         try:
-            f = open(args.tumor_mpileup, 'r')
+            f = open(args.tumor_bam or args.tumor_mpileup, 'r')
         except:
-            sys.exit('Failed to open file {}'.format(args.tumor_mpileup))
+            sys.exit('Failed to open file {}'.format(
+                args.tumor_bam or args.tumor_mpileup))
+elif args.type == 'multisample':
+    if not args.sample:
+        sys.exit('--sample is required for multisample vcf')
+    sample_ids = [sample_id for sample_id, _ in args.sample]
+    if len(set(sample_ids)) != len(sample_ids):
+        sys.exit('The --sample ids must be unique')
+    for _, pileup in args.sample:
+        try:
+            f = open(pileup, 'r')
+        except:
+            sys.exit('Failed to open file {}'.format(pileup))
+if args.jobs < 1:
+    sys.exit('The number of jobs must be at least 1')
+if args.block_size < 1:
+    sys.exit('The block size must be at least 1')
 
 
 ###############################################################################
@@ -106,72 +249,87 @@ normal_mpileup = args.normal_mpileup
 tumor_mpileup = args.tumor_mpileup
 normal_id = args.normal_id
 tumor_id = args.tumor_id
+bam_in = args.bam
+normal_bam = args.normal_bam
+tumor_bam = args.tumor_bam
+reference = args.reference
+samples = args.sample
+index = args.index
+# The contigs are ranked by the ##contig lines of the vcf when streaming
+contig_order = ContigOrder() if args.sorted_inputs else None
 
 ###############################################################################
 
+# Read the mpileup files, and store into dictionaries
+# Due to multi-allelic variants, need to read the whole mpileup files in first
+# (unless the files are sorted, or the bams are read directly)
 if vcf_type == 'germline':
-
-    # Read the mpileup file, and store into dictionary
-    # Due to multi-allelic variants, need to read the whole mpileup file in first
-    mpileup_dict = create_mpileup_dict(mpileup_in)
-
-    with open(vcf_in, 'r') as f_vcf, open(vcf_out, 'w') as f_vcf_out:
-        for line in f_vcf:
-
-            # Write the header lines
-            if line.startswith('##'):
-                f_vcf_out.write(line)
-            elif line.startswith('#'):
-                for new_line in BAM_STATS_LINES:
-                    f_vcf_out.write(new_line)
-                f_vcf_out.write(line)
-
-            # Calcualte bam stats for variants
-            else:
-                variant = Variant().read_variant(line)
-                mpileup = mpileup_dict.get('\t'.join([variant.chr, variant.pos]),
-                                         '')
-                bam_stats = variant.cal_bam_stats(mpileup)
-                variant = variant.add_bam_stats(bam_stats)
-                f_vcf_out.write(variant.write())
-
+    lookups = [pileup_lookup(mpileup_in, bam_in, reference, contig_order)]
+elif vcf_type == 'somatic':
+    lookups = [pileup_lookup(normal_mpileup, normal_bam, reference,
+                             contig_order),
+               pileup_lookup(tumor_mpileup, tumor_bam, reference,
+                             contig_order)]
 else:
+    # The pileups of all the samples are read in step with the vcf, in one pass
+    sample_lookups = {}
+    for sample_id, pileup in samples:
+        if is_bam(pileup):
+            sample_lookups[sample_id] = pileup_lookup(None, pileup, reference)
+        else:
+            sample_lookups[sample_id] = pileup_lookup(pileup, None, None,
+                                                      contig_order)
+columns = None
 
-    normal_mpileup_dict = create_mpileup_dict(normal_mpileup)
-    tumor_mpileup_dict = create_mpileup_dict(tumor_mpileup)
+with open_vcf(vcf_in) as vcf_i, open_vcf(vcf_out, 'w', index) as vcf_o:
 
-    with open(vcf_in, 'r') as vcf_i, open(vcf_out, 'w') as vcf_o:
-        for line in vcf_i:
-            if line.startswith('#'):
-                if line.startswith('##'):
-                    vcf_o.write(line)
+    # Write the header lines
+    for line in vcf_i:
+        if line.startswith('##'):
+            if contig_order and line.startswith('##contig='):
+                contig_order.index(contig_id(line))
+            vcf_o.write(line)
+            continue
+        for new_line in BAM_STATS_LINES:
+            vcf_o.write(new_line)
+        if vcf_type == 'somatic':
+            line = line.split()
+            try:
+                normal_index = line.index(normal_id)
+            except:
+                sys.exit('Failed to match normal sample id')
+            try:
+                tumor_index = line.index(tumor_id)
+            except:
+                sys.exit('Failed to match tumor sample id')
+            columns = (normal_index, tumor_index)
+            line = '\t'.join(line[:-2] + [normal_id, tumor_id+'\n'])
+        elif vcf_type == 'multisample':
+            # The pileup index of each sample column, None if not annotated
+            sample_ids = line.rstrip('\n').split('\t')[9:]
+            for sample_id in sample_lookups:
+                if sample_id not in sample_ids:
+                    sys.exit('Failed to match sample id {}'.format(sample_id))
+            lookups, columns = [], []
+            for sample_id in sample_ids:
+                if sample_id in sample_lookups:
+                    columns.append(len(lookups))
+                    lookups.append(sample_lookups[sample_id])
                 else:
-                    for new_line in BAM_STATS_LINES:
-                        vcf_o.write(new_line)
-                    line = line.split()
-                    try:
-                        normal_index = line.index(normal_id)
-                    except:
-                        sys.exit('Failed to match normal sample id')
-                    try:
-                        tumor_index = line.index(tumor_id)
-                    except:
-                        sys.exit('Failed to match tumor sample id')
-                    line = '\t'.join(line[:-2] + [normal_id, tumor_id+'\n'])
-                    vcf_o.write(line)
-            else:
-                variant = Variant().read_variant(line, somatic=True,
-                                                 normal=normal_index,
-                                                 tumor=tumor_index)
-                normal_mpileup = normal_mpileup_dict.get('\t'.join([variant.chr,
-                                                       variant.pos]), '')
-                tumor_mpileup = tumor_mpileup_dict.get('\t'.join([variant.chr,
-                                                     variant.pos]), '')
-                normal_bam_stats = variant.cal_bam_stats(normal_mpileup)
-                tumor_bam_stats = variant.cal_bam_stats(tumor_mpileup)
-                variant = variant.add_bam_stats([normal_bam_stats,
-                                                tumor_bam_stats],
-                                                somatic=True)
-                vcf_o.write(variant.write(somatic=True))
-
+                    columns.append(None)
+        vcf_o.write(line)
+        break
 
+    # Calcualte bam stats for variants, in blocks
+    jobs = ((block, vcf_type, columns) for block in
+            pileup_blocks(vcf_i, lookups, args.block_size))
+    if args.jobs == 1:
+        for lines in map(annotate_block, jobs):
+            vcf_o.write(lines)
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs,
+                                 mp_context=multiprocessing.get_context(
+                                     "fork")) as pool:
+            for lines in ordered_map(pool, annotate_block, jobs,
+                                     2 * args.jobs):
+                vcf_o.write(lines)
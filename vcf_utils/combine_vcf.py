@@ -9,8 +9,11 @@ Modified: 29-05-2019 (Michael Franklin)
 Extract (and normalise) information from input vcfs coming from different
 callers, combine to one vcf, and calcualte mean and standard deviation of AD and DP if specified.
 Works on germline and somatic vcfs.
-Warning: the output vcf is not sorted by chromosome and position, users are advised to use other tools to sort this vcf. (Example: bcftools sort vcf -o sorted_vcf)
-         Tested on HaplotypeCaller and Mutect2 (gatk 4.0.10.0), strelka (2.9.2) and vardict (1.5.1)
+Input vcfs can be plain text or gzip/bgzip compressed. An output name ending with .gz is written bgzipped (and indexed with --index).
+The output vcf is sorted by the ##contig order and position (contigs without a ##contig line follow, in the order they are seen).
+With --sorted-inputs, the (coordinate sorted) inputs are merged as streams instead of being read into memory.
+
+Tested on HaplotypeCaller and Mutect2 (gatk 4.0.10.0), strelka (2.9.2) and vardict (1.5.1)
 
 Notes on how the columns are being parsed:
 -- AD/DP: INFO value overwritten by FORMAT value (if FORMAT value exists), in the process_(somatic_)variant
@@ -25,11 +28,252 @@ A bug: Currently this script doesn't support output file in a directory that doe
 import os
 import sys
 import argparse
-from collections import OrderedDict, defaultdict as dd, Counter
-from itertools import combinations
-from normalisedvcf import NormalisedVcf, sort_vcf
-from variant import Variant
-from vcfheader import STATS_HEADER, SOMATIC_STATS_HEADER, HEADER
+import subprocess
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, Counter
+from itertools import combinations, islice
+from normalisedvcf import NormalisedVcf, sort_vcf, merge_sorted_vcfs, \
+    process_vcf_job, vcf_contigs, split_by_contig
+from variant import Variant, cal_stats
+from vcfheader import STATS_HEADER, SOMATIC_STATS_HEADER, HEADER, \
+    ContigOrder, MetaInfo
+from vcfsort import SORT_BUFFER, sorted_lines, vcf_sort_key
+from vcfio import INDEX_FORMATS, MAX_POS, find_index, is_gzip, open_vcf, \
+    parse_region
+
+###############################################################################
+
+# Number of variants combined together (see combine_records)
+COMBINE_BLOCK_SIZE = 10000
+
+###############################################################################
+
+def combine_records(block, callers, cols, somatic=False):
+    """Combine the records of a block of variants into vcf lines, the mean
+    and sd of AD / DP are calculated for the whole block (see cal_stats)
+    Input:
+        block, list of the records of each variant, a list of (caller index,
+        variant) in the order of the callers
+        callers, caller names
+        cols, the columns to keep
+    """
+    combined = []
+    for records in block:
+        callers_names = [callers[i] for i, variant in records]
+        info_dict = OrderedDict()
+        for i, variant in records:
+            # Combine the selected information in the dictionary
+            info_dict.update(variant.info)
+        if somatic and callers_names[0] == 'strelka':
+            variant = records[-1][1]
+        else:
+            variant = records[0][1]
+        combined.append((variant, callers_names, info_dict,
+                         variant.stats_values(cols, info_dict, somatic)))
+
+    # The (mean, sd) of each AD / DP, for each variant
+    stats = [{} for _ in combined]
+    if combined:
+        for name in combined[0][3]:
+            for variant_stats, name_stats in zip(stats, cal_stats(
+                    name[:2], [values[name] for *_, values in combined])):
+                variant_stats[name] = name_stats
+
+    lines = []
+    for j, variant_stats in enumerate(stats):
+        variant, callers_names, info_dict, values = combined[j]
+        # The dictionaries of a variant are freed once its line is written
+        combined[j], stats[j] = None, None
+        combined_variant = Variant.combine_info(variant, cols, callers_names,
+                                                info_dict, somatic=somatic,
+                                                stats=variant_stats)
+        lines.append(Variant.write(combined_variant, somatic=somatic))
+    return lines
+
+
+def write_header(f, meta_info, vcf_list, somatic=False, normal_id=None,
+                 tumor_id=None):
+    """Write the combined meta info (MetaInfo of the vcfs) and header lines
+    """
+    meta_info.write(f)
+    if not somatic:
+        for line in STATS_HEADER:
+            f.write(line)
+        # write the chr\tpos\t... line
+        f.write(vcf_list[0].header)
+    else:
+        for line in SOMATIC_STATS_HEADER:
+            f.write(line)
+        f.write("\t".join([HEADER, normal_id, tumor_id+"\n"]))
+
+
+def caller_mask(indexes):
+    """Bitmask of the callers a variant is found by (bit i for caller i)
+    """
+    mask = 0
+    for i in indexes:
+        mask |= 1 << i
+    return mask
+
+
+def write_summary(summary, callers, membership):
+    """Write the count of variants found by each caller, and the union and
+    intersection of every combination of callers. These are all summed from
+    the histogram of the caller masks, whatever the number of variants
+    Input: membership, Counter of {caller mask: variant count}
+    """
+    vcf_combintaion=[]
+    for i in range(2, len(callers)+1):
+            for j in list(combinations(range(len(callers)),i)):
+                vcf_combintaion.append(j)
+
+    # found_by_all[m]: variants found by (at least) all the callers in m
+    # found_by_any[m]: variants found by only callers in m
+    all_callers = (1 << len(callers)) - 1
+    found_by_all = [0] * (all_callers + 1)
+    for m, n in membership.items():
+        found_by_all[m] += n
+    found_by_any = list(found_by_all)
+    for i in range(len(callers)):
+        for m in range(all_callers + 1):
+            if m & 1 << i:
+                found_by_any[m] += found_by_any[m ^ 1 << i]
+            else:
+                found_by_all[m] += found_by_all[m | 1 << i]
+    total = found_by_any[all_callers]
+
+    with open(summary, "w") as f:
+        f.write("Caller\tCount\n")
+        # Do calculation of the combination
+        for i, vcf in enumerate(callers):
+            count = found_by_all[1 << i]
+            f.write(vcf + "\t" + str(count) + "\n")
+        # Calculate union (all the variants, less the ones found by the other
+        # callers only)
+        for j in vcf_combintaion:
+            count = total - found_by_any[all_callers ^ caller_mask(j)]
+            f.write("+".join([callers[c] for c in j]) + "\t" + str(count) + "\n")
+        # Calculate intersection
+        for j in vcf_combintaion:
+            count = found_by_all[caller_mask(j)]
+            f.write("-".join([callers[c] for c in j]) + "\t" + str(count) + "\n")
+
+
+@contextmanager
+def open_combined(args):
+    """Open the combined vcf for writing. With --parquet, the lines written
+    also go to the parquet table of the variants
+    """
+    with open_vcf(args.o, "w", args.index) as combined_f:
+        if not args.parquet:
+            yield combined_f
+        else:
+            # Only imported with --parquet, as it loads pyarrow
+            from vcftable import VariantTable
+            with VariantTable(args.parquet, combined_f) as table:
+                yield table
+
+
+def shard_by_contig(args, summary):
+    """Run combine_vcf.py on each contig (args.jobs processes at a time) and
+    concatenate the sorted outputs, regions and summary counts in the contig
+    order. A shard fetches its contig from the bgzipped inputs with a tbi/csi
+    index. The other inputs (all of them with --cache-dir, whose keys hash
+    the whole vcf) are split by contig once, before the shards run
+    """
+    # Arguments passed on to each shard
+    cmd = [sys.executable, os.path.abspath(__file__), "--columns",
+           args.columns, "--type", args.type, "--sort-buffer",
+           str(args.sort_buffer)]
+    if args.normal:
+        cmd += ["--normal", args.normal]
+    if args.tumor:
+        cmd += ["--tumor", args.tumor]
+    if args.priority:
+        cmd += ["--priority", ",".join(args.priority)]
+    if args.sorted_inputs:
+        cmd += ["--sorted-inputs"]
+    if args.tmp_dir:
+        cmd += ["--tmp-dir", os.path.abspath(args.tmp_dir)]
+    if args.cache_dir:
+        cmd += ["--cache-dir", os.path.abspath(args.cache_dir)]
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        # The shards run in their own directories
+        tmp_dir = os.path.abspath(tmp_dir)
+        # Per input: the vcf for each contig (None for a fetched input), and
+        # the header written for the contigs it has no variant on
+        inputs, vcf_contig_lists = [], []
+        for i, vcf in enumerate(args.i):
+            if not args.cache_dir and is_gzip(vcf) and find_index(vcf):
+                inputs.append((os.path.abspath(vcf), None, None))
+                vcf_contig_lists.append(vcf_contigs(vcf))
+            else:
+                split_dir = os.path.join(tmp_dir, "input{}".format(i))
+                os.mkdir(split_dir)
+                header, contigs, paths = split_by_contig(vcf, split_dir)
+                inputs.append((split_dir, header, paths))
+                vcf_contig_lists.append(contigs)
+        contig_order = ContigOrder(contig for contigs in vcf_contig_lists
+                                   for contig in contigs)
+        contigs = list(contig_order.rank)
+        shard_dirs = [os.path.join(tmp_dir, str(i)) for i in
+                      range(len(contigs))]
+
+        def run_shard(i):
+            os.mkdir(shard_dirs[i])
+            shard_cmd = list(cmd)
+            for j, (vcf, header, paths) in enumerate(inputs):
+                if paths is None:
+                    shard_cmd += ["-i", vcf]
+                elif contigs[i] in paths:
+                    shard_cmd += ["-i", paths[contigs[i]]]
+                else:
+                    # No variant on the contig, the caller is still combined
+                    empty = os.path.join(shard_dirs[i],
+                                         "input{}.vcf".format(j))
+                    with open(empty, "w") as f:
+                        f.writelines(header)
+                    shard_cmd += ["-i", empty]
+            # Each shard writes its summary in its own directory
+            return subprocess.run(shard_cmd + ["--contig", contigs[i], "-o",
+                                  "shard.vcf", "--regions", "shard.tsv"],
+                                  cwd=shard_dirs[i]).returncode
+
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            returncodes = list(pool.map(run_shard, range(len(contigs))))
+        failed = [contigs[i] for i, code in enumerate(returncodes) if code]
+        if failed:
+            sys.exit("Failed to combine contig(s): {}".format(", ".join(failed)))
+
+        with open_combined(args) as combined_f:
+            for i, shard_dir in enumerate(shard_dirs):
+                with open(os.path.join(shard_dir, "shard.vcf")) as f:
+                    for line in f:
+                        # The header is the same in all the shards
+                        if i == 0 or not line.startswith("#"):
+                            combined_f.write(line)
+        if args.regions:
+            with open(args.regions, "w") as loc_f:
+                for shard_dir in shard_dirs:
+                    with open(os.path.join(shard_dir, "shard.tsv")) as f:
+                        loc_f.writelines(f)
+
+        # The shards have no variant in common, so the counts add up
+        counts = OrderedDict()
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, summary)) as f:
+                next(f)
+                for line in f:
+                    name, count = line.rstrip("\n").split("\t")
+                    counts[name] = counts.get(name, 0) + int(count)
+        with open(summary, "w") as f:
+            f.write("Caller\tCount\n")
+            for name, count in counts.items():
+                f.write(name + "\t" + str(count) + "\n")
 
 ###############################################################################
 
@@ -48,7 +292,8 @@ required.add_argument("-i",  help="input vcfs, the priority of the vcfs will be
                       specified more than once", action="append", required=True)
 required.add_argument("--columns", help="A list of columns, seperated by ','",
                       required=True)
-required.add_argument("-o", help="output vcf (unsorted)", required=True)
+required.add_argument("-o", help="output vcf (sorted by the ##contig order and \
+                      position)", required=True)
 required.add_argument("--type", help="must be either germline or somatic", required=True,
                       choices=recognised_modes)
 parser._action_groups.append(optional)
@@ -60,6 +305,37 @@ required.add_argument("--tumor", help="tumor sample ID, required if inputs are \
                       somatic vcfs", required=False)
 required.add_argument("--priority", help="The priority of the callers, must match \
                       with the callers in the source header, seperated by ','", required=False)
+optional.add_argument("--sorted-inputs", help="The input vcfs are sorted by \
+                      coordinate (in the ##contig order). Merge them as \
+                      streams, which keeps only the current locus in memory \
+                      and writes a sorted output", action="store_true")
+optional.add_argument("--sort-buffer", help="Number of variants sorted in \
+                      memory before spilling to temporary files (default: \
+                      %(default)s)", type=int, default=SORT_BUFFER)
+optional.add_argument("--tmp-dir", help="Directory for the temporary sort \
+                      files (default: system temporary directory)")
+optional.add_argument("--jobs", help="Number of processes used to parse the \
+                      input vcfs (default: %(default)s, ignored with \
+                      --sorted-inputs)", type=int, default=1)
+optional.add_argument("--cache-dir", help="Directory caching the parsed input \
+                      vcfs, by their content, the columns and sample ids. The \
+                      unchanged vcfs are loaded from there by the next runs \
+                      (ignored with --sorted-inputs)")
+optional.add_argument("--region", help="Only combine the variants with POS in \
+                      the region chr:start-end (uses the tbi/csi index of \
+                      bgzipped inputs if there is one)")
+optional.add_argument("--contig", help="Only combine the variants on the contig \
+                      (uses the tbi/csi index of bgzipped inputs if there is \
+                      one)")
+optional.add_argument("--shard-by-contig", help="Combine each contig in a \
+                      separate process (--jobs at a time), and concatenate \
+                      the outputs. Inputs without a tbi/csi index are split \
+                      by contig first", action="store_true")
+optional.add_argument("--parquet", help="Also write the combined variants to \
+                      this parquet table, with a typed column for each INFO \
+                      field (requires pyarrow)")
+optional.add_argument("--index", help="Index the output vcf, which is bgzipped \
+                      if the name ends with .gz", choices=INDEX_FORMATS)
 args = parser.parse_args()
 
 # Sanity check number of inputs
@@ -93,6 +369,22 @@ if args.type not in recognised_modes:
 if args.type == "somatic" and not (args.normal and args.tumor):
     sys.exit("normal and tumor ids are required for somatic vcfs")
 
+if args.jobs < 1:
+    sys.exit("The number of jobs must be at least 1")
+
+if sum(map(bool, [args.region, args.contig, args.shard_by_contig])) > 1:
+    sys.exit("Only one of --region, --contig and --shard-by-contig can be used")
+
+if args.parquet:
+    from vcftable import check_pyarrow
+    check_pyarrow(args.parquet)
+
+if args.cache_dir:
+    try:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    except OSError:
+        sys.exit("Failed to create the cache directory {}".format(args.cache_dir))
+
 ###############################################################################
 
 vcf_in = args.i
@@ -102,151 +394,140 @@ regions = args.regions
 vcf_type = args.type
 normal_id = args.normal
 tumor_id = args.tumor
+somatic = vcf_type == "somatic"
+summary = "Combine_variants_summary.tsv"
+if args.region:
+    region = parse_region(args.region)
+elif args.contig:
+    region = (args.contig, 0, MAX_POS)
+else:
+    region = None
 
 ###############################################################################
 
-if vcf_type == "germline":
-
-    # A list of cleaned vcf with extracted columns
-    vcf_list = [NormalisedVcf(vcf).process_vcf(columns_to_keep) for vcf
-                in vcf_in]
-
-    # Combine the variants into a list
-    combined_variants, variant_to_vcf_dict = [], dd(list)
-    callers = [vcf.caller for vcf in vcf_list]
-
-    if args.priority:
-        if set(callers) != set(args.priority):
-            sys.exit("The callers specified in the argument priority [{0}]are different from the vcfs [{1}]".format(', '.join(map(str, args.priority)), ', '.join(map(str, callers))))
-
-    # Sort the vcf
-    vcf_list, callers = sort_vcf(args.priority, callers, vcf_list)
-
-    for i, vcf in enumerate(vcf_list):
-        combined_variants += list(vcf.variants.keys())
-        # Dictionary that let varaint refer back to vcf
-        for var in vcf.variants.keys():
-            variant_to_vcf_dict[var].append(i)
-
-    # Take the unquie variants, don"t sort them
-    combined_variants = list(set(combined_variants))
-
-    # Take the unquie header lines with preserved order
-    # To do: Do we want to reorder the header lines?
-    #        Protentially contain redundant lines
-    combined_header = []
-    for vcf in vcf_list:
-        combined_header += vcf.meta_info
+if args.shard_by_contig:
+    shard_by_contig(args, summary)
+    sys.exit(0)
 
-    # Write the combined vcf
-    with open(vcf_out, "w") as combined_f:
-
-        # Write the meta info and header lines
-        for line in list(OrderedDict.fromkeys(combined_header)):
-            combined_f.write(line)
-        for line in STATS_HEADER:
-            combined_f.write(line)
-        # write the chr\tpos\t... line
-        combined_f.write(vcf_list[0].header)
-
-        # Write the variants
-        for v_key in combined_variants:
-            callers_indexes = variant_to_vcf_dict[v_key]
-            callers_names = [callers[i] for i in callers_indexes]
-            info_dict = OrderedDict()
-            for i in callers_indexes:
-                # Combine the selected information in the dictionary
-                info_dict.update(vcf_list[i].variants[v_key].info)
-            i = callers_indexes[0]
-            combined_variant = Variant.combine_info(
-                               vcf_list[i].variants[v_key], columns_to_keep,
-                               callers_names, info_dict)
-            combined_f.write(Variant.write(combined_variant))
+if args.sorted_inputs:
 
+    # Only read the headers, the variants are merged as streams
+    if not somatic:
+        vcf_list = [NormalisedVcf(vcf, region).read_header(columns_to_keep)
+                    for vcf in vcf_in]
+    else:
+        vcf_list = [NormalisedVcf(vcf, region).read_somatic_header(
+                    columns_to_keep, normal_id, tumor_id) for vcf in vcf_in]
 else:
-
     # Process each vcf and extract the information from the selected columns
-    vcf_list = [NormalisedVcf(vcf).process_somatic_vcf(columns_to_keep,
-                normal_id, tumor_id) for vcf in vcf_in]
-
-    # Combine the variants into a list
-    combined_variants, variant_to_vcf_dict = [], dd(list)
-    callers = [vcf.caller for vcf in vcf_list]
+    # (or load it from the cache)
+    jobs = [(vcf, columns_to_keep, normal_id if somatic else None,
+             tumor_id if somatic else None, region, args.cache_dir)
+            for vcf in vcf_in]
+    if args.jobs > 1:
+        # Parse each vcf in a worker process
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(jobs)),
+                                 mp_context=multiprocessing.get_context(
+                                     "fork")) as pool:
+            vcf_list = list(pool.map(process_vcf_job, jobs))
+    else:
+        vcf_list = [process_vcf_job(job) for job in jobs]
+
+callers = [vcf.caller for vcf in vcf_list]
 
-    if args.priority:
-        if set(callers) != set(args.priority):
-            sys.exit("The callers specified in the argument priority [{0}]are different from the vcfs [{1}]".format(', '.join(map(str, priority)), ', '.join(map(str, callers))))
+if args.priority:
+    if set(callers) != set(args.priority):
+        sys.exit("The callers specified in the argument priority [{0}]are different from the vcfs [{1}]".format(', '.join(map(str, args.priority)), ', '.join(map(str, callers))))
+
+# Sort the vcf
+vcf_list, callers = sort_vcf(args.priority, callers, vcf_list)
+
+# Count of variants for each combination of callers, for the summary
+membership = Counter()
+
+# Merge the meta info lines of the vcfs, the contigs are ranked by the
+# ##contig lines
+meta_info = MetaInfo(line for vcf in vcf_list for line in vcf.meta_info)
+contig_order = meta_info.contig_order()
+
+if args.sorted_inputs:
+
+    regions_f = open(regions, "w") if regions else None
+
+    # Write the combined vcf, one locus at a time
+    with open_combined(args) as combined_f:
+        write_header(combined_f, meta_info, vcf_list, somatic, normal_id,
+                     tumor_id)
+        merged = merge_sorted_vcfs(vcf_list, contig_order)
+        while True:
+            block = list(islice(merged, COMBINE_BLOCK_SIZE))
+            if not block:
+                break
+            masks = [caller_mask(i for i, variant in records)
+                     for v_key, records in block]
+            lines = combine_records([records for v_key, records in block],
+                                    callers, columns_to_keep, somatic)
+            # The variants of the block are not needed any more, free them
+            # before the next block is read
+            del block
+            for mask, line in zip(masks, lines):
+                membership[mask] += 1
+                combined_f.write(line)
+                if regions_f:
+                    regions_f.write("\t".join(line.split("\t", 2)[:2]) + "\n")
+            del masks, lines
+
+    if regions_f:
+        regions_f.close()
 
-    # Sort the vcf
-    vcf_list, callers = sort_vcf(args.priority, callers, vcf_list)
+else:
 
+    # The unique variants, and the mask of the vcfs each is found in
+    variant_masks = {}
     for i, vcf in enumerate(vcf_list):
-        combined_variants += list(vcf.variants.keys())
-        # Dictionary that let varaint refer back to vcf
-        for var in vcf.variants.keys():
-            variant_to_vcf_dict[var].append(i)
+        for var in vcf.records:
+            variant_masks[var] = variant_masks.get(var, 0) | 1 << i
+    combined_variants = list(variant_masks)
 
-    combined_variants = list(set(combined_variants))
-
-    combined_header = []
+    # Rank the contigs without a ##contig line in the order they first
+    # appear in the vcfs
     for vcf in vcf_list:
-        combined_header += vcf.meta_info
-
-    # Write the combined vcf
-    with open(vcf_out, "w") as combined_f:
-
-        # Write the meta info and header lines
-        for line in list(OrderedDict.fromkeys(combined_header)):
+        for var in vcf.records:
+            contig_order.index(var[0])
+
+    def combined_lines():
+        for start in range(0, len(combined_variants), COMBINE_BLOCK_SIZE):
+            block = []
+            for v_key in combined_variants[start:start + COMBINE_BLOCK_SIZE]:
+                mask = variant_masks[v_key]
+                membership[mask] += 1
+                # The variants are only built from their records here
+                block.append([(i, Variant.from_record(vcf.records[v_key],
+                                                      somatic))
+                              for i, vcf in enumerate(vcf_list)
+                              if mask & 1 << i])
+            lines = combine_records(block, callers, columns_to_keep, somatic)
+            # Free the variants of the block before its lines are sorted, and
+            # the lines before the next block is built
+            del block
+            yield from lines
+            del lines
+
+    regions_f = open(regions, "w") if regions else None
+
+    # Write the combined vcf, sorted by contig and position
+    with open_combined(args) as combined_f:
+        write_header(combined_f, meta_info, vcf_list, somatic, normal_id,
+                     tumor_id)
+        for line in sorted_lines(combined_lines(), vcf_sort_key(contig_order),
+                                 args.sort_buffer, args.tmp_dir):
             combined_f.write(line)
-        for line in SOMATIC_STATS_HEADER:
-            combined_f.write(line)
-        # write the chr\tpos\t... line
-        combined_f.write("\t".join([HEADER, normal_id, tumor_id+"\n"]))
-
-        # Write the variants
-        for v_key in combined_variants:
-            callers_indexes = variant_to_vcf_dict[v_key]
-            callers_names = [callers[i] for i in callers_indexes]
-            info_dict = OrderedDict()
-            for i in callers_indexes:
-                info_dict.update(vcf_list[i].variants[v_key].info)
-            if callers_names[0] == 'strelka':
-                i = callers_indexes[-1]
-            else:
-            	i = callers_indexes[0]
-            combined_variant = Variant.combine_info(
-                               vcf_list[i].variants[v_key], columns_to_keep,
-                               callers_names, info_dict, somatic=True)
-            combined_f.write(Variant.write(combined_variant, somatic=True))
+            # Write variant location file for samtools pileup
+            if regions_f:
+                regions_f.write("\t".join(line.split("\t", 2)[:2]) + "\n")
+
+    if regions_f:
+        regions_f.close()
 
 # Output combine varaints summary count
-# Raw contains all the variants in each of the vcf
-vcf_combintaion_raw = [set(vcf.variants.keys()) for vcf in vcf_list]
-vcf_combintaion=[]
-for i in range(2, len(callers)+1):
-        for j in list(combinations(range(len(callers)),i)):
-            vcf_combintaion.append(j)
-
-with open("Combine_variants_summary.tsv", "w") as f:
-    f.write("Caller\tCount\n")
-    # Do calculation of the combination
-    for i, vcf in enumerate(callers):
-        f.write(vcf + "\t" + str(len(vcf_combintaion_raw[i])) + "\n") 
-    # Calculate union
-    for j in vcf_combintaion:
-        union_variants=set()
-        for caller_index in j:
-            union_variants.update(vcf_combintaion_raw[caller_index])
-        f.write("+".join([callers[c] for c in j]) + "\t" + str(len(union_variants)) + "\n")
-    # Calculate intersection
-    for j in vcf_combintaion:
-        newset = [vcf_combintaion_raw[s] for s in j]
-        intersect_variants=set.intersection(*newset)
-        f.write("-".join([callers[c] for c in j]) + "\t" + str(len(intersect_variants)) + "\n")
-
-
-# Write variant location file for samtools pileup
-if regions:
-    with open(regions, "w") as loc_f:
-        for v_key in combined_variants:
-            loc_f.write("\t".join(v_key.split()[:2]) + "\n")
+write_summary(summary, callers, membership)
@@ -1,12 +1,24 @@
+import os
 import sys
+import heapq
+import hashlib
+import pickle
+import tempfile
 from collections import OrderedDict as od
-from vcfheader import VcfHeader, extract_cols, extract_cols_somatic
-from variant import Variant
+from vcfheader import VcfHeader, extract_cols, extract_cols_somatic, contig_id
+from variant import Variant, info_pattern
+from vcfio import open_vcf, fetch, find_index, is_gzip, read_index
 
 ##############################################################################
 
 AF_LINE = '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency, \
 for each ALT allele, in the same order as listed">'
+# Changed when the normalised variants change, so the older cached vcfs are
+# not used
+CACHE_VERSION = 3
+HASH_CHUNK_SIZE = 1 << 20
+# Contig vcfs kept open at a time when splitting a vcf by contig
+MAX_OPEN_FILES = 256
 
 ##############################################################################
 
@@ -35,6 +47,165 @@ from the vcfs".format(' '.join(priority), ' '.join(callers)))
         callers = sorted(callers, key=lambda caller: caller.lower())
     return vcf_list, callers
 
+
+def iter_loci(vcf, index, contig_order):
+    """Yield (sort key, index, variant) from a coordinate sorted vcf whose
+    header has been read. Records sharing a position are held and ordered by
+    REF/ALT, so the stream is sorted on (contig, POS, REF, ALT)
+    """
+    locus, records = None, []
+    for variant in vcf.iter_variants():
+        key = (contig_order.index(variant.chr),) + variant.variant_key[1:]
+        if key[:2] != locus:
+            if locus is not None and key[:2] < locus:
+                sys.exit("Vcf {} is not sorted by coordinate at {}:{}, please \
+sort it or run without --sorted-inputs".format(vcf.name, variant.chr,
+                                               variant.pos))
+            for record in sorted(records, key=lambda r: r[0]):
+                yield record
+            locus, records = key[:2], []
+        records.append((key, index, variant))
+    for record in sorted(records, key=lambda r: r[0]):
+        yield record
+
+
+def merge_sorted_vcfs(vcf_list, contig_order):
+    """k-way merge of coordinate sorted vcfs (after read_(somatic_)header)
+    Output (in order of contig, pos, ref, alt):
+        variant_key, list of (index in vcf_list, variant)
+    """
+    streams = [iter_loci(vcf, i, contig_order) for i, vcf in
+               enumerate(vcf_list)]
+    current_key, records = None, od()
+    for key, i, variant in heapq.merge(*streams, key=lambda r: r[:2]):
+        if key != current_key:
+            if records:
+                yield variant_key, list(records.items())
+            current_key, variant_key, records = key, variant.variant_key, od()
+        # Duplicated records in one vcf: keep the last, as process_vcf does
+        records[i] = variant
+    if records:
+        yield variant_key, list(records.items())
+
+def file_digest(path):
+    """sha256 of the content of a file (hex)
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, vcfname, cols, nid, tid, region):
+    """Path of the cached NormalisedVcf, keyed by the content of the vcf, the
+    columns, sample ids and region it is processed with
+    """
+    key = repr((CACHE_VERSION, file_digest(vcfname), list(cols), nid, tid,
+                region))
+    return os.path.join(cache_dir,
+                        hashlib.sha256(key.encode()).hexdigest() + '.pickle')
+
+
+def process_vcf_job(job):
+    """Process a vcf (in a worker process with --jobs)
+    Input: (vcf name, cols, normal id, tumor id, region, cache dir), ids are
+           None if germline, region is None for the whole vcf. If the cache
+           dir is not None, the NormalisedVcf is loaded from there when the
+           same vcf was processed the same way before, otherwise it is saved
+           there
+    Output: the NormalisedVcf, with all its variants as compact records
+    """
+    vcfname, cols, nid, tid, region, cache_dir = job
+    if cache_dir is not None:
+        cached = cache_path(cache_dir, vcfname, cols, nid, tid, region)
+        try:
+            with open(cached, 'rb') as f:
+                vcf = pickle.load(f)
+            # The same content may be under another name
+            vcf.name = vcfname
+            return vcf
+        except Exception:
+            # Not cached (or unreadable), process it again
+            pass
+
+    if nid is None and tid is None:
+        vcf = NormalisedVcf(vcfname, region).process_vcf(cols)
+    else:
+        vcf = NormalisedVcf(vcfname, region).process_somatic_vcf(cols, nid,
+                                                                 tid)
+    vcf.compact()
+
+    if cache_dir is not None:
+        # Written under a temporary name first, so concurrent runs never read
+        # a partial file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+            pickle.dump(vcf, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, cached)
+    return vcf
+
+
+def vcf_contigs(vcfname):
+    """Contigs of a vcf: those of the ##contig lines, then the ones with
+    variants but no ##contig line. These are read from the tbi/csi index of a
+    bgzipped vcf if there is one, otherwise from the variants (in the order
+    they are first seen)
+    """
+    contigs = []
+    index = find_index(vcfname) if is_gzip(vcfname) else None
+    with open_vcf(vcfname) as vcf:
+        for line in vcf:
+            if line.startswith('##contig='):
+                contigs.append(contig_id(line))
+            elif not line.startswith('#'):
+                if index:
+                    break
+                contig = line.split('\t', 1)[0]
+                if contig not in contigs:
+                    contigs.append(contig)
+    if index:
+        contigs += [contig for contig in read_index(index)[2]
+                    if contig not in contigs]
+    return contigs
+
+
+def split_by_contig(vcfname, out_dir):
+    """Split a vcf, in one pass, into a plain vcf per contig in out_dir, each
+    with the header of the vcf
+    Output: (header lines, contigs of the ##contig lines then of the variants
+            in the order they are first seen, {contig: vcf name})
+    """
+    header, contigs, paths, files = [], [], od(), {}
+    with open_vcf(vcfname) as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                header.append(line)
+                if line.startswith('##contig='):
+                    contigs.append(contig_id(line))
+                continue
+            contig = line.split('\t', 1)[0]
+            f = files.get(contig)
+            if f is None:
+                # Unsorted vcfs can jump between many contigs
+                if len(files) == MAX_OPEN_FILES:
+                    for f in files.values():
+                        f.close()
+                    files = {}
+                if contig in paths:
+                    f = open(paths[contig], 'a')
+                else:
+                    paths[contig] = os.path.join(out_dir,
+                                                 '{}.vcf'.format(len(paths)))
+                    f = open(paths[contig], 'w')
+                    f.writelines(header)
+                    if contig not in contigs:
+                        contigs.append(contig)
+                files[contig] = f
+            f.write(line)
+    for f in files.values():
+        f.close()
+    return header, contigs, paths
+
 ##############################################################################
 
 
@@ -45,20 +216,62 @@ class NormalisedVcf:
     caller: string, extracted from the vcf line ##source
     meta_info: meta info lines (list)
     header: #CHROM\t.... (string)
+    contigs: contig ids in the order of the ##contig lines (list)
+    region: only read the variants with POS in (contig, beg, end), or None
     variants: variant objects query by 'CHROM_POS_ID_REF_ALF' (dictionary)
+    records: the variants as compact tuples, after compact (dictionary)
     """
 
-    def __init__(self, vcfname):
+    def __init__(self, vcfname, region=None):
         self.name = vcfname
+        self.region = region
         self.caller = ''
         self.meta_info = []
         self.header = ''
+        self.contigs = []
         self.variants = {}
+        self.records = {}
+        self.somatic = False
+        self.info_cols, self.format_cols = od(), od()
+        self.info_pattern = None
+        self.normal_index, self.tumor_index = None, None
+        self._vcf = None
+        self._line_number = 0
 
     def process_vcf(self, cols):
         """Build object from vcf
         """
-        vcf = open(self.name, 'r')
+        self.read_header(cols)
+        for variant in self.iter_variants():
+            # The dictionary is query by (chr, pos, ref, alt)
+            self.variants.update({variant.variant_key: variant})
+        return self
+
+    def process_somatic_vcf(self, cols, nid, tid):
+        """Process somatic vcf, with normal and tumor sample id provided
+        """
+        self.read_somatic_header(cols, nid, tid)
+        for variant in self.iter_variants():
+            # The dictionary is query by (chr, pos, ref, alt)
+            self.variants.update({variant.variant_key: variant})
+        return self
+
+    def compact(self):
+        """Replace the variants by their compact records (Variant.record),
+        which are much quicker to pickle back from a worker process (or to
+        the cache) and smaller to keep. Variant.from_record rebuilds them
+        """
+        names = {}
+        self.records = {key: variant.record(names, self.somatic)
+                        for key, variant in self.variants.items()}
+        self.variants = {}
+        return self
+
+    def read_header(self, cols):
+        """Read the meta-information and header lines of a germline vcf,
+        leaving the file positioned at the first variant
+        """
+        vcf = open_vcf(self.name)
         info_dict, format_dict = {}, {}
 
         # Read the meta-information lines from the vcf
@@ -77,6 +290,8 @@ class NormalisedVcf:
             elif line.startswith('##'):
                 if line.startswith('##source='):
                     self.caller = line.replace('##source=', '').strip()
+                elif line.startswith('##contig='):
+                    self.contigs.append(contig_id(line))
                 self.meta_info.append(line)
             else:
                 break
@@ -104,23 +319,18 @@ class NormalisedVcf:
         self.meta_info += [VcfHeader.write(v) for k, v in format_cols.items()]
 
         self.header = line
-
-        # Continue to read the file, this time the variants
-        for j, line in enumerate(vcf):
-            variant = Variant().process_variant(line, caller=self.caller)
-            if variant.alt == '*':
-                print("Warning: Vcf {} line {} has variant with alt=*".format(self.caller, str(i+j+1)))
-            cleaned_variant = Variant.select_info(variant, info_cols, format_cols)
-            # The dictionary is query by chr\tpos\tref\talt
-            self.variants.update({cleaned_variant.variant_key: cleaned_variant})
-
+        self.info_cols, self.format_cols = info_cols, format_cols
+        # Only the selected columns are pulled out of INFO
+        self.info_pattern = info_pattern(info_cols.keys())
+        self._vcf, self._line_number = vcf, i + 1
         return self
 
-    def process_somatic_vcf(self, cols, nid, tid):
-        """Process somatic vcf, with normal and tumor sample id provided
+    def read_somatic_header(self, cols, nid, tid):
+        """Read the meta-information and header lines of a somatic vcf, with
+        normal and tumor sample id provided
         """
 
-        vcf = open(self.name, 'r')
+        vcf = open_vcf(self.name)
         info_dict, format_dict = od(), od()
 
         # Read the meta-information lines from the vcf
@@ -140,6 +350,8 @@ class NormalisedVcf:
             elif line.startswith('##'):
                 if line.startswith('##source='):
                     self.caller = line.replace('##source=', '').strip()
+                elif line.startswith('##contig='):
+                    self.contigs.append(contig_id(line))
                 self.meta_info.append(line)
             else:
                 break
@@ -174,17 +386,40 @@ class NormalisedVcf:
             sys.exit("Normal sample id [{}] or tumor sample id [{}] didn't match with file {}: [{}], [{}]"
                      .format(nid, tid, self.name, self.header.split()[9], self.header.split()[10]))
 
-        # Continue to read the file, this time the variants
-        for j, line in enumerate(vcf):
-            variant = Variant().process_somatic_variant(
-                    line, self.caller, normal_index, tumor_index)
-            if variant.alt == '*':
-                print("Warning: Line {} contains variant with alt=*".format(str(i+j+1)))
-            cleaned_variant = Variant.select_info(variant, info_cols, format_cols,
-                                                  caller=self.caller, somatic=True)
-            # The dictionary is query by chr\tpos\tref\talt
-            self.variants.update({cleaned_variant.variant_key: cleaned_variant})
-
+        self.somatic = True
+        self.info_cols, self.format_cols = info_cols, format_cols
+        # Only the selected columns are pulled out of INFO
+        self.info_pattern = info_pattern(info_cols.keys())
+        self.normal_index, self.tumor_index = normal_index, tumor_index
+        self._vcf, self._line_number = vcf, i + 1
         return self
 
+    def iter_variants(self):
+        """Continue to read the file after read_(somatic_)header, yielding
+        the cleaned variants one at a time
+        """
+        if self.region:
+            # Use the index if there is one
+            lines = fetch(self.name, self.region, self._vcf)
+        else:
+            lines = self._vcf
+        for j, line in enumerate(lines):
+            if not self.somatic:
+                variant = Variant().process_variant(line, caller=self.caller)
+                if variant.alt == '*':
+                    print("Warning: Vcf {} line {} has variant with alt=*".format(self.caller, str(self._line_number+j)))
+                yield Variant.select_info(variant, self.info_cols,
+                                          self.format_cols,
+                                          pattern=self.info_pattern)
+            else:
+                variant = Variant().process_somatic_variant(
+                        line, self.caller, self.normal_index, self.tumor_index)
+                if variant.alt == '*':
+                    print("Warning: Line {} contains variant with alt=*".format(str(self._line_number+j)))
+                yield Variant.select_info(variant, self.info_cols,
+                                          self.format_cols,
+                                          caller=self.caller, somatic=True,
+                                          pattern=self.info_pattern)
+        self._vcf.close()
+        self._vcf = None
 
@@ -0,0 +1,252 @@
+import re
+import sys
+from collections import Counter
+from vcfio import open_vcf
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+##############################################################################
+
+# Indel (+2CA / -2ca), start of read (^ followed by the mapping quality) or
+# end of read
+PILEUP_TOKEN = re.compile(r'([+-])(\d+)|\^.|\$', re.S)
+# Maximum reads per position, as samtools mpileup -d 10000
+MAX_DEPTH = 10000
+# Bases (and deletions) counted by tokenize_pileups
+PILEUP_BASES = '.,ACGTNacgtn*#<>'
+# Longest indel token (e.g. '+12ACGTACGTACGT') counted with NumPy
+PILEUP_INDEL_WIDTH = 24
+if np is not None:
+    PILEUP_BASE_CODES = [ord(base) for base in PILEUP_BASES]
+    PILEUP_DIGITS = np.zeros(256, dtype=bool)
+    PILEUP_DIGITS[ord('0'):ord('9') + 1] = True
+
+##############################################################################
+
+
+def tokenize_pileup(bases):
+    """Tokenize the read bases column of an mpileup line in a single pass
+    Output:
+        bases without the indels and read start/end marks (string)
+        count of each of these bases, including '.' and ',' (Counter)
+        count of each indel, as written in the pileup, e.g. '+2CA' (Counter)
+    """
+    pieces, indels = [], Counter()
+    pos = 0
+    while True:
+        match = PILEUP_TOKEN.search(bases, pos)
+        if match is None:
+            pieces.append(bases[pos:])
+            break
+        pieces.append(bases[pos:match.start()])
+        if match.group(1):
+            # The indel is followed by its length and sequence
+            pos = match.end() + int(match.group(2))
+            indels[bases[match.start():pos]] += 1
+        else:
+            pos = match.end()
+    bases = ''.join(pieces)
+    return bases, Counter(bases), indels
+
+
+def tokenize_pileups(pileups):
+    """Tokenize a block of read bases columns at once, as tokenize_pileup
+    does for each of them. Each distinct pileup is tokenized once, so the
+    records sharing a position (multi-allelic or overlapping variants, or
+    the same pileup for several samples) look up the same tokens. With
+    NumPy, the start/end marks and indels of the whole block are found
+    together, and each line is counted in one pass
+    Output: {bases: tokens}, shared by the records, do not modify them. With
+            NumPy, the tokens are (None, counts, indels): the bases without
+            the marks are left out (see Variant.cal_bam_stats), and the
+            counts are of the PILEUP_BASES only
+    """
+    unique = list(dict.fromkeys(pileups))
+    if np is None or not unique:
+        return {bases: tokenize_pileup(bases) for bases in unique}
+    data = '\n'.join(unique).encode('latin-1')
+    buf = np.frombuffer(data, dtype=np.uint8)
+    lengths = np.fromiter(map(len, unique), dtype=np.int64, count=len(unique))
+    ends = np.cumsum(lengths + 1) - 1
+
+    # Start of reads: a '^' is followed by the mapping quality, which can be
+    # a '^' too, so the marks are at the even offsets of a run of '^' (and
+    # not at the end of a line)
+    carets = np.flatnonzero(buf == 94)
+    run_start = np.ones(len(carets), dtype=bool)
+    run_start[1:] = carets[1:] != carets[:-1] + 1
+    offset = np.arange(len(carets))
+    offset -= np.maximum.accumulate(np.where(run_start, offset, 0))
+    mapq = carets[offset % 2 == 0] + 1
+    mapq = mapq[mapq < ends[np.searchsorted(ends, mapq - 1)]]
+
+    # Indels: '+' / '-' (unless it is a mapping quality), the length and the
+    # indel sequence. The length is parsed for all of them at once, one digit
+    # at a time
+    padded = np.concatenate((buf, np.zeros(1, dtype=np.uint8)))
+    starts = np.flatnonzero((buf == 43) | (buf == 45))
+    starts = starts[~np.isin(starts, mapq, assume_unique=True)]
+    starts = starts[PILEUP_DIGITS[padded[starts + 1]]]
+    digits = starts + 1
+    length = np.zeros(len(starts), dtype=np.int64)
+    is_digit = np.ones(len(starts), dtype=bool)
+    while is_digit.any():
+        length[is_digit] = length[is_digit] * 10 + padded[digits[is_digit]] - 48
+        digits[is_digit] += 1
+        is_digit &= PILEUP_DIGITS[padded[digits]]
+    lines = np.searchsorted(ends, starts)
+    stops = np.minimum(digits + length, ends[lines])
+
+    # Count the indels of each line: the indels up to PILEUP_INDEL_WIDTH are
+    # counted together as fixed width rows, prefixed with their line
+    indels = [Counter() for _ in unique]
+    widths = stops - starts
+    short = widths <= PILEUP_INDEL_WIDTH
+    rows = np.zeros((int(short.sum()), 8 + PILEUP_INDEL_WIDTH),
+                    dtype=np.uint8)
+    rows[:, :8] = lines[short].astype('>i8').view(np.uint8).reshape(-1, 8)
+    columns = np.arange(PILEUP_INDEL_WIDTH)
+    inside = columns < widths[short, None]
+    rows[:, 8:][inside] = buf[(starts[short, None] + columns)[inside]]
+    rows = rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+    rows, row_counts = np.unique(rows, return_counts=True)
+    for row, count in zip(rows.tolist(), row_counts.tolist()):
+        indel = row[8:].rstrip(b'\0').decode('latin-1')
+        indels[int.from_bytes(row[:8], 'big')][indel] = count
+    for start, stop, line in zip(starts[~short].tolist(),
+                                 stops[~short].tolist(),
+                                 lines[~short].tolist()):
+        indels[line][data[start:stop].decode('latin-1')] += 1
+
+    # Count the bases of each line, less the mapping qualities and indel
+    # sequences (the other token characters are not counted anyway)
+    seq_lengths = np.maximum(stops - digits, 0)
+    seqs = np.arange(seq_lengths.sum()) + np.repeat(
+        digits - np.cumsum(seq_lengths) + seq_lengths, seq_lengths)
+    skipped = np.concatenate((mapq, seqs))
+    skipped = np.bincount(np.searchsorted(ends, skipped) * 256 + buf[skipped],
+                          minlength=len(unique) * 256)
+    skipped = skipped.reshape(len(unique), 256)[:, PILEUP_BASE_CODES]
+    counts = np.array([np.bincount(buf[start:end], minlength=256)
+                       for start, end in zip((ends - lengths).tolist(),
+                                             ends.tolist())])
+    counts = (counts[:, PILEUP_BASE_CODES] - skipped).tolist()
+
+    tokens = {}
+    for bases, line_counts, line_indels in zip(unique, counts, indels):
+        tokens[bases] = (None,
+                         Counter({base: count for base, count in
+                                  zip(PILEUP_BASES, line_counts) if count}),
+                         line_indels)
+    return tokens
+
+##############################################################################
+
+
+class MpileupStream:
+    """Read a coordinate sorted mpileup in step with a vcf sorted in the same
+    order, keeping only the line at the current position
+    Attributes:
+    contig_order: ContigOrder shared with the vcf (from its ##contig lines)
+    """
+
+    def __init__(self, mpileup, contig_order):
+        self.name = mpileup
+        self.contig_order = contig_order
+        self._f = None
+        self._key, self._line = None, None
+        self._last = None
+
+    def _advance(self):
+        line = next(self._f, None)
+        if line is None:
+            self._key, self._line = None, None
+            self._f.close()
+        else:
+            line = line.rstrip('\n').split('\t')
+            key = (self.contig_order.index(line[0]), int(line[1]))
+            if self._key is not None and key < self._key:
+                sys.exit('The mpileup {} is not sorted in the order of the vcf '
+                         'at {}:{}'.format(self.name, line[0], line[1]))
+            self._key, self._line = key, line
+
+    def get(self, chrom, pos):
+        """Get [depth, bases] of the mpileup line at the position, or '' if
+        there is no line
+        """
+        key = (self.contig_order.index(chrom), int(pos))
+        if self._f is None:
+            # Only start reading when the vcf header has been read
+            self._f = open_vcf(self.name)
+            self._advance()
+        elif key < self._last:
+            sys.exit('The vcf is not sorted at {}:{}, cannot stream {}'
+                     .format(chrom, pos, self.name))
+        self._last = key
+
+        while self._key is not None and self._key < key:
+            self._advance()
+        if self._key != key:
+            return ''
+        return self._line[3:5]
+
+
+class BamPileup:
+    """Pileup the reads of an indexed bam/cram at the vcf positions only,
+    as samtools mpileup -A -B -Q 0 -d 10000 -f reference would
+    Attributes:
+    reference: the fasta the reads are aligned to, marking the reference
+               matches as '.' and ','
+    """
+
+    def __init__(self, bam, reference, max_depth=MAX_DEPTH):
+        if pysam is None:
+            sys.exit('pysam is required to read {}'.format(bam))
+        self.name = bam
+        self.reference = reference
+        self.max_depth = max_depth
+        self._bam, self._fasta = None, None
+        self._key, self._line = None, ''
+
+    def get(self, chrom, pos):
+        """Get [depth, bases] of the pileup at the position, or '' if no read
+        covers it
+        """
+        key = (chrom, pos)
+        # The records at a position are consecutive, only pileup once
+        if key == self._key:
+            return self._line
+        if self._bam is None:
+            try:
+                self._fasta = pysam.FastaFile(self.reference)
+                self._bam = pysam.AlignmentFile(
+                    self.name, reference_filename=self.reference)
+            except (IOError, OSError, ValueError) as e:
+                sys.exit('Failed to open file {}: {}'.format(self.name, e))
+        self._key, self._line = key, ''
+        pos = int(pos) - 1
+        if chrom not in self._bam.references:
+            return ''
+        columns = self._bam.pileup(chrom, pos, pos + 1, truncate=True,
+                                   stepper='samtools', fastafile=self._fasta,
+                                   ignore_orphans=False, compute_baq=False,
+                                   min_base_quality=0,
+                                   max_depth=self.max_depth,
+                                   multiple_iterators=False)
+        for column in columns:
+            # No read start/end marks: pysam splits the bases on ':', which
+            # is the start mark of a MAPQ 25 read ('^:'). They are not
+            # counted anyway (see tokenize_pileup)
+            bases = column.get_query_sequences(mark_matches=True,
+                                               mark_ends=False,
+                                               add_indels=True)
+            if bases:
+                self._line = [str(len(bases)), ''.join(bases)]
+        return self._line
@@ -0,0 +1,157 @@
+"""
+Compare the pileups of BamPileup (pysam) with the mpileup path, on a small
+synthetic bam, and check the streaming of sorted mpileups:
+python3 -m unittest test_pileup (from vcf_utils)
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from pileup import BamPileup, MpileupStream, pysam, tokenize_pileup
+from vcfheader import ContigOrder
+
+###############################################################################
+
+CHROM = 'chr1'
+REF_LENGTH = 300
+READ_LENGTH = 40
+# Mapping quality written as ':' after the '^' of a read start
+MAPQ_COLON = ord(':') - 33
+
+###############################################################################
+
+
+def write_bam(tmp_dir):
+    """Write a reference and an indexed bam of random reads (with mismatches,
+    indels and a MAPQ 25 read starting at position 101)
+    Output: (bam, reference)
+    """
+    rng = random.Random(1)
+    seq = ''.join(rng.choice('ACGT') for _ in range(REF_LENGTH))
+    reference = os.path.join(tmp_dir, 'ref.fa')
+    with open(reference, 'w') as f:
+        f.write('>{}\n{}\n'.format(CHROM, seq))
+    pysam.faidx(reference)
+
+    reads = []
+    starts = [100] * 3 + [rng.randrange(REF_LENGTH - READ_LENGTH - 5)
+                          for _ in range(60)]
+    for i, start in enumerate(sorted(starts)):
+        read = pysam.AlignedSegment()
+        read.query_name = 'r{}'.format(i)
+        read.reference_id = 0
+        read.reference_start = start
+        read.mapping_quality = MAPQ_COLON if start == 100 else rng.choice(
+            [0, 25, 40, 60])
+        read.flag = 16 if rng.random() < 0.5 else 0
+        bases = list(seq[start:start + READ_LENGTH])
+        kind = rng.random()
+        if kind < 0.2:
+            # 2bp insertion
+            read.cigartuples = [(0, 20), (1, 2), (0, READ_LENGTH - 20)]
+            bases[20:20] = ['T', 'T']
+        elif kind < 0.4:
+            # 3bp deletion
+            read.cigartuples = [(0, 20), (2, 3), (0, READ_LENGTH - 23)]
+            del bases[20:23]
+        else:
+            read.cigartuples = [(0, READ_LENGTH)]
+        for j in range(len(bases)):
+            if rng.random() < 0.05:
+                bases[j] = rng.choice('ACGT')
+        read.query_sequence = ''.join(bases)
+        read.query_qualities = pysam.qualitystring_to_array('I' * len(bases))
+        reads.append(read)
+
+    bam = os.path.join(tmp_dir, 's.bam')
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': CHROM, 'LN': REF_LENGTH}]}
+    with pysam.AlignmentFile(bam, 'wb', header=header) as f:
+        for read in reads:
+            f.write(read)
+    pysam.index(bam)
+    return bam, reference
+
+
+@unittest.skipIf(pysam is None, 'pysam is not installed')
+class TestBamPileup(unittest.TestCase):
+
+    def test_same_as_mpileup(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bam, reference = write_bam(tmp_dir)
+            mpileup = {}
+            for line in pysam.mpileup('-A', '-B', '-Q', '0', '-d', '10000',
+                                      '-f', reference, bam).splitlines():
+                line = line.split('\t')
+                mpileup[int(line[1])] = line[3:5]
+            # A read start with MAPQ 25 is marked '^:'
+            self.assertIn('^:', mpileup[101][1])
+
+            pileup = BamPileup(bam, reference)
+            for pos in range(1, REF_LENGTH + 1):
+                expected = mpileup.get(pos, '')
+                got = pileup.get(CHROM, str(pos))
+                if not expected:
+                    self.assertEqual(got, '')
+                    continue
+                # Same depth, bases and indels (read start/end marks aside)
+                self.assertEqual(got[0], expected[0], pos)
+                self.assertEqual(tokenize_pileup(got[1])[1:],
+                                 tokenize_pileup(expected[1])[1:], pos)
+
+
+def write_mpileup(tmp_dir, positions):
+    """Write an mpileup with a line at each (contig, pos)
+    Output: the mpileup name
+    """
+    mpileup = os.path.join(tmp_dir, 's.mpileup')
+    with open(mpileup, 'w') as f:
+        for chrom, pos in positions:
+            f.write('{}\t{}\tA\t{}\t.,\tII\n'.format(chrom, pos, pos % 7))
+    return mpileup
+
+
+class TestMpileupStream(unittest.TestCase):
+
+    def test_merge_join(self):
+        positions = [('chr1', 5), ('chr1', 9), ('chr2', 1), ('chr2', 3)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stream = MpileupStream(write_mpileup(tmp_dir, positions),
+                                   ContigOrder(['chr1', 'chr2']))
+            self.assertEqual(stream.get('chr1', '1'), '')
+            self.assertEqual(stream.get('chr1', '9'), ['2', '.,'])
+            # Records sharing a position get the same line
+            self.assertEqual(stream.get('chr1', '9'), ['2', '.,'])
+            self.assertEqual(stream.get('chr2', '2'), '')
+            self.assertEqual(stream.get('chr2', '3'), ['3', '.,'])
+            self.assertEqual(stream.get('chr2', '4'), '')
+
+    def test_unsorted_vcf(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stream = MpileupStream(write_mpileup(tmp_dir, [('chr1', 5)]),
+                                   ContigOrder(['chr1']))
+            stream.get('chr1', '5')
+            with self.assertRaises(SystemExit):
+                stream.get('chr1', '4')
+
+    def test_unsorted_mpileup(self):
+        # Contigs in another order than the vcf (e.g. of the bam header)
+        positions = [('chr2', 1), ('chr1', 5)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stream = MpileupStream(write_mpileup(tmp_dir, positions),
+                                   ContigOrder(['chr1', 'chr2']))
+            stream.get('chr1', '5')
+            with self.assertRaises(SystemExit):
+                stream.get('chr2', '2')
+        # A swapped line
+        positions = [('chr1', 5), ('chr1', 9), ('chr1', 7)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stream = MpileupStream(write_mpileup(tmp_dir, positions),
+                                   ContigOrder(['chr1']))
+            with self.assertRaises(SystemExit):
+                stream.get('chr1', '10')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+"""
+Round trips of the BGZF writer and the tbi/csi indexes of vcfio, checked
+against pysam (htslib) and by reading them back with fetch:
+python3 -m unittest test_vcfio (from vcf_utils)
+"""
+
+import gzip
+import os
+import random
+import tempfile
+import unittest
+from pileup import pysam
+from vcfio import MAX_POS, MIN_SHIFT, BgzfWriter, bgzf_compress, fetch, \
+    open_vcf, parse_region, reg2bin, reg2bins
+
+###############################################################################
+
+# Contig lengths, over several 16kb windows and bins, one name with ':'
+CONTIGS = [('chr1', 1200000), ('chr2', 70000), ('HLA-A*01:01:01:01', 3500)]
+HEADER = ['##fileformat=VCFv4.2'] + \
+    ['##contig=<ID={},length={}>'.format(*contig) for contig in CONTIGS] + \
+    ['##INFO=<ID=END,Number=1,Type=Integer,Description="End position">',
+     '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+WINDOW = 1 << MIN_SHIFT
+
+###############################################################################
+
+
+def vcf_lines():
+    """Sorted records of random length (enough for many BGZF blocks), some at
+    the window and bin edges, some spanning several windows with END
+    """
+    rng = random.Random(5)
+    lines = [line + '\n' for line in HEADER]
+    for contig, length in CONTIGS:
+        positions = {1, length, WINDOW, WINDOW + 1, 5 * WINDOW, 8 * WINDOW,
+                     8 * WINDOW + 1} | {rng.randrange(1, length)
+                                        for _ in range(length // 100)}
+        for pos in sorted(p for p in positions if p <= length):
+            if pos == 5 * WINDOW:
+                # Overlaps the next two windows only through its END, which
+                # are in other BGZF blocks (after 100kb of long records)
+                lines.append('{}\t{}\t.\tA\t<DEL>\t50\tPASS\tEND={}\n'
+                             .format(contig, pos, 7 * WINDOW + 10))
+                lines += ['{}\t{}\t{}\tA\tC\t50\tPASS\t.\n'.format(
+                    contig, pos, 'x' * 1000)] * 100
+            ref = ''.join(rng.choice('ACGT') for _ in range(rng.randrange(
+                1, 6)))
+            info = 'END={}'.format(pos + rng.randrange(WINDOW, 3 * WINDOW)) \
+                if rng.random() < 0.01 else '.'
+            lines.append('{}\t{}\t.\t{}\tA\t50\tPASS\t{}\n'.format(
+                contig, pos, ref, info))
+    return lines
+
+
+def regions():
+    """Regions at the edges of the windows, bins and contigs, as
+    (contig, beg, end) 0-based half-open
+    """
+    edges = [(0, 1), (0, WINDOW), (WINDOW - 1, WINDOW + 1), (WINDOW, WINDOW),
+             (8 * WINDOW - 1, 8 * WINDOW + 2), (100, 2 * WINDOW + 5),
+             (3 * WINDOW, 40 * WINDOW), (6 * WINDOW, 6 * WINDOW + 10),
+             (0, MAX_POS)]
+    result = [('chrMissing', 0, MAX_POS)]
+    for contig, length in CONTIGS:
+        result += [(contig, beg, end) for beg, end in edges if end > beg]
+        result += [(contig, length - 1, length), (contig, length - 10,
+                                                  length + 10)]
+    return result
+
+
+def in_region(line, region):
+    """The record has its POS in the region
+    """
+    contig, beg, end = region
+    fields = line.split('\t', 2)
+    return fields[0] == contig and beg < int(fields[1]) <= end
+
+
+class TestBgzf(unittest.TestCase):
+
+    def test_write_read(self):
+        lines = vcf_lines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'a.vcf.gz')
+            with open_vcf(path, 'w') as f:
+                f.writelines(lines)
+            self.assertFalse(os.path.exists(path + '.tbi'))
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.readlines(), lines)
+            with open_vcf(path) as f:
+                self.assertEqual(f.readlines(), lines)
+
+    def test_bytes(self):
+        data = b''.join(line.encode() for line in vcf_lines())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'a.vcf.gz')
+            with BgzfWriter(path) as f:
+                f.write(data[:100])
+                f.write(data[100:])
+            with open_vcf(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_write_blocks(self):
+        # Blocks compressed apart (e.g. by worker processes), after the
+        # header written as text
+        lines = vcf_lines()
+        header = [line for line in lines if line.startswith('#')]
+        records = ''.join(lines[len(header):]).encode()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'a.vcf.gz')
+            with open_vcf(path, 'w') as f:
+                f.writelines(header)
+                for i in range(0, len(records), 100000):
+                    f.write_blocks(bgzf_compress(records[i:i + 100000]))
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.readlines(), lines)
+            if pysam is not None:
+                with pysam.BGZFile(path) as f:
+                    self.assertEqual(f.read().decode(), ''.join(lines))
+
+
+class TestIndex(unittest.TestCase):
+
+    def check_index(self, index_format):
+        lines = vcf_lines()
+        records = [line for line in lines if not line.startswith('#')]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'a.vcf.gz')
+            with open_vcf(path, 'w', index_format) as f:
+                # Lines split across the writes
+                text = ''.join(lines)
+                for i in range(0, len(text), 7777):
+                    f.write(text[i:i + 7777])
+            index = '{}.{}'.format(path, index_format)
+            self.assertTrue(os.path.exists(index))
+
+            tabix = pysam.TabixFile(path, index=index) if pysam else None
+            for region in regions():
+                expected = [line for line in records if in_region(line,
+                                                                  region)]
+                self.assertEqual(list(fetch(path, region)), expected, region)
+                if tabix is None or region[0] not in tabix.contigs:
+                    continue
+                # htslib gives the records overlapping the region
+                contig, beg, end = region
+                got = [line + '\n' for line in tabix.fetch(
+                    contig, beg, min(end, 1 << 29))]
+                self.assertEqual([line for line in got
+                                  if in_region(line, region)], expected,
+                                 region)
+                self.assertEqual(
+                    got, [line for line in records if line.startswith(
+                        contig + '\t') and overlaps(line, beg, end)], region)
+
+    def test_tbi(self):
+        self.check_index('tbi')
+
+    def test_csi(self):
+        self.check_index('csi')
+
+    @unittest.skipIf(pysam is None, 'pysam is not installed')
+    def test_htslib_index(self):
+        lines = vcf_lines()
+        records = [line for line in lines if not line.startswith('#')]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plain = os.path.join(tmp_dir, 'a.vcf')
+            with open(plain, 'w') as f:
+                f.writelines(lines)
+            for csi in (False, True):
+                path = pysam.tabix_index(plain, preset='vcf', csi=csi,
+                                         keep_original=True, force=True)
+                for region in regions():
+                    self.assertEqual(list(fetch(path, region)),
+                                     [line for line in records
+                                      if in_region(line, region)], region)
+                os.remove(path + ('.csi' if csi else '.tbi'))
+
+
+def overlaps(line, beg, end):
+    """The record (with its END) overlaps [beg, end)
+    """
+    fields = line.rstrip('\n').split('\t')
+    start = int(fields[1]) - 1
+    stop = start + len(fields[3])
+    if fields[7].startswith('END='):
+        stop = max(stop, int(fields[7][len('END='):]))
+    return start < end and beg < stop
+
+
+class TestBins(unittest.TestCase):
+
+    def test_reg2bins(self):
+        rng = random.Random(2)
+        for _ in range(1000):
+            beg = rng.randrange(1 << 26)
+            end = beg + rng.randrange(1, 1 << rng.randrange(1, 20))
+            # The smallest bin containing a region is one of its bins
+            self.assertIn(reg2bin(beg, end), reg2bins(beg, end))
+            self.assertIn(reg2bin(end - 1, end), reg2bins(beg, end))
+
+
+class TestParseRegion(unittest.TestCase):
+
+    def test_regions(self):
+        self.assertEqual(parse_region('chr1'), ('chr1', 0, MAX_POS))
+        self.assertEqual(parse_region('chr1:100'), ('chr1', 99, MAX_POS))
+        self.assertEqual(parse_region('chr1:1,000-2,000'),
+                         ('chr1', 999, 2000))
+        self.assertEqual(parse_region('chr1:5-5'), ('chr1', 4, 5))
+
+    def test_contig_with_colon(self):
+        self.assertEqual(parse_region('HLA-A*01:01:01:01:1-500'),
+                         ('HLA-A*01:01:01:01', 0, 500))
+        self.assertEqual(parse_region('chrUn:KI270302v1'),
+                         ('chrUn:KI270302v1', 0, MAX_POS))
+        self.assertEqual(parse_region('{HLA-A*01:01}'),
+                         ('HLA-A*01:01', 0, MAX_POS))
+        self.assertEqual(parse_region('{HLA-A*01:01}:5-10'),
+                         ('HLA-A*01:01', 4, 10))
+
+    def test_invalid(self):
+        for region in ['chr1:0-5', 'chr1:5-4', ':1-5', '{chr1', '{chr1}5',
+                       '{}']:
+            with self.assertRaises(SystemExit):
+                parse_region(region)
+
+
+if __name__ == '__main__':
+    unittest.main()
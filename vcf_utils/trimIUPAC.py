@@ -9,87 +9,211 @@ Modifications:
     03-01-2020 (Jiaan Yu) - Fixed bug when substiting IUPAC code in INDELs
 
 Substitute 'W|K|Y|R|S|M' with 'N'
+The vcf is streamed as bytes: the records without IUPAC codes in REF/ALT
+(almost all of them) are matched in one pass and copied unchanged, only the
+others are split and rewritten. The input and output can be gzip/bgzip
+compressed, or '-' for stdin / stdout.
+Each replaced record is logged (as it is found) to a JSON Lines file, and
+the counts of replacements, by IUPAC code and by contig, are written to the
+stats json.
+The records are trimmed in blocks of whole lines. With --threads, the
+blocks are trimmed in parallel processes, which also bgzip them for a
+bgzipped output (unless it is indexed), and written back in the input order
+(the output is the same as with one process). The main process only reads
+the vcf (a compressed input is decompressed in a thread of its own) and
+writes the blocks, most of the work is done by the workers.
 """
 
 ###############################################################################
 
+import io
 import sys
 import re
 import os
 import json
+import argparse
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from vcfio import INDEX_FORMATS, BgzfWriter, bgzf_compress, open_vcf, \
+    ordered_map
 
 # We'll filter out the characters listed in this set:
 # https://en.wikipedia.org/wiki/Nucleic_acid_notation
 character_set = ["W", "S", "M", "K", "R", "Y", "B", "D", "H", "V", "N", "Z"]
+IUPAC_CODES = "".join(character_set).encode()
+TO_N = bytes.maketrans(IUPAC_CODES, b"N" * len(IUPAC_CODES))
+# Size of the blocks of records trimmed together (bytes, rounded up to the
+# end of a line)
+BLOCK_SIZE = 1 << 22
+
+
+def clean_record(indRef, indAlt):
+    """Pattern matching a record without IUPAC codes in its REF and ALT
+    columns, only reading the line up to these columns
+    """
+    fields = []
+    for i in range(max(indRef, indAlt) + 1):
+        if i in (indRef, indAlt):
+            fields.append(b"[^\t\r\n" + IUPAC_CODES + b"]*")
+        else:
+            fields.append(b"[^\t\r\n]*")
+    return re.compile(b"\t".join(fields) + b"(?:[\t\r\n]|$)")
+
+
+def read_blocks(inputfp, line_number, block_size=BLOCK_SIZE):
+    """Split the rest of the vcf into blocks of whole lines
+    Output: (block, line number of its first line)
+    """
+    while True:
+        block = inputfp.read(block_size)
+        if not block:
+            break
+        block += inputfp.readline()
+        yield block, line_number
+        line_number += block.count(b"\n")
+
+
+def trim_block(job):
+    """Convert the IUPAC codes of a block of records to Ns (in a worker
+    process with --threads)
+    Input: (block, line number of its first line, indRef, indAlt, compress)
+    Output: (trimmed block, bgzipped if compress, log of the replaced
+            records, count of each IUPAC code replaced, count of replacements
+            on each contig)
+    """
+    block, line_number, indRef, indAlt, compress = job
+    clean = clean_record(indRef, indAlt).match
+    trimmed, log = [], []
+    code_counts, contig_counts = Counter(), Counter()
+
+    for line in io.BytesIO(block):
+        if line.startswith(b"##") or (clean(line) and line.endswith(b"\n")):
+            # No IUPAC code, copy the record as it is (unless the newline is
+            # missing at the end of the file)
+            trimmed.append(line)
+            line_number += 1
+            continue
 
-USAGE="USAGE: %s <inVcf> <outVcf>\n\nTake out ambiguity (IUPAC) codes in REF and ALT columns by converting them to Ns.\n\n" % sys.argv[0]
-
-if len(sys.argv) <= 2:
-    print(USAGE + "\033[91mError: An invalid number of parameters was provided (%s / 2).\033[0m\n" % (len(sys.argv) -1))
-    sys.exit(1)
-
-inpath = sys.argv[1]
-outpath = sys.argv[2]
-
-if not os.path.exists(inpath):
+        processed = line.rstrip(b"\n\r").split(b"\t")
+        lIndRef, lIndAlt = processed[indRef], processed[indAlt]
+        d = {}
+        if len(lIndRef.translate(None, IUPAC_CODES)) != len(lIndRef):
+            d["indRef"] = lIndRef.decode()
+            processed[indRef] = lIndRef.translate(TO_N)
+
+        if len(lIndAlt.translate(None, IUPAC_CODES)) != len(lIndAlt):
+            d["indAlt"] = lIndAlt.decode()
+            processed[indAlt] = lIndAlt.translate(TO_N)
+
+        if d:
+            # {line, chrom, pos, indRef: prev, indAlt: prev}
+            chrom = processed[0].decode()
+            log.append(json.dumps(dict(line=line_number, chrom=chrom,
+                                       pos=int(processed[1]), **d)) + "\n")
+            contig_counts[chrom] += len(d)
+            for prev in d.values():
+                code_counts.update(c for c in prev if c in character_set)
+
+        trimmed.append(b"\t".join(processed) + b"\n")
+        line_number += 1
+
+    trimmed = b"".join(trimmed)
+    if compress:
+        trimmed = bgzf_compress(trimmed)
+    return trimmed, "".join(log), code_counts, contig_counts
+
+
+def trimmed_blocks(jobs, threads):
+    """Trim the blocks (in threads processes), in the input order
+    """
+    if threads == 1:
+        yield from map(trim_block, jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=threads,
+                                 mp_context=multiprocessing.get_context(
+                                     "fork")) as pool:
+            yield from ordered_map(pool, trim_block, jobs, 2 * threads)
+
+
+parser = argparse.ArgumentParser(description="Take out ambiguity (IUPAC) codes \
+                                 in REF and ALT columns by converting them to Ns.")
+parser.add_argument("inVcf", help="input vcf (plain text or gzip/bgzip \
+                    compressed), '-' for stdin")
+parser.add_argument("outVcf", help="output vcf, bgzipped if the name ends \
+                    with .gz, '-' for stdout")
+parser.add_argument("--index", help="Index the (bgzipped) output vcf",
+                    choices=INDEX_FORMATS)
+parser.add_argument("--stats", help="Counts of the replacements (json, \
+                    default: %(default)s)", default="stats.json")
+parser.add_argument("--replacements", help="Log of the replaced REF/ALT, one \
+                    json record per line (default: the stats path, with \
+                    .jsonl instead of .json)")
+parser.add_argument("--threads", help="Number of processes trimming (and \
+                    bgzipping) blocks of the vcf (default: 1)", type=int,
+                    default=1)
+args = parser.parse_args()
+
+inpath = args.inVcf
+outpath = args.outVcf
+statspath = args.stats
+logpath = args.replacements or os.path.splitext(statspath)[0] + ".jsonl"
+
+if inpath != "-" and not os.path.exists(inpath):
     print("\033[91mThe input file '%s' could not be found, or is not accessible\033[0m" % inpath)
     sys.exit(1)
 
-if os.path.exists(outpath):
+if outpath != "-" and os.path.exists(outpath):
     print("\033[91mA file already exists at the output path '%s'\033[0m" % outpath)
     sys.exit(1)
 
-replacements = 0
-replacement_dict = {
-    # $line: { indRef: prev, indAlt: prev }
-}
+if args.threads < 1:
+    sys.exit("The number of threads must be at least 1")
 
-line_number = 0
+# Number of each IUPAC code replaced, and of replacements on each contig
+code_counts, contig_counts = Counter(), Counter()
 
-with open(inpath) as inputfp, open(outpath,'w') as outputfp:
-    extrahead_elems = []
+line_number = 0
 
+with open_vcf(inpath, 'rb') as inputfp, \
+        open_vcf(outpath, 'wb', args.index) as outputfp, \
+        open(logpath, "w") as logfp:
     indRef = None   # header.index("REF")
     indAlt = None   # header.index("ALT")
 
-    p = re.compile("|".join(character_set))
     for line in inputfp:
         line_number += 1    # was started at 0, so lines will start at 1
 
-        if line.startswith("##"):
+        if line.startswith(b"##"):
             # just stream the header to new file
             outputfp.write(line)
             continue
 
-        # probably write extrahead params here
-
-        processed = line.rstrip("\n\r").split("\t")
-
-        if indRef is None or indAlt is None:
-            indRef = processed.index("REF")
-            indAlt = processed.index("ALT")
-        else:
-            lIndRef, lIndAlt = processed[indRef], processed[indAlt]
-            has_indRefMatch = p.search(lIndRef)
-            has_indAltMatch = p.search(lIndAlt)
-            if has_indRefMatch or has_indAltMatch:
-                d = {}
-                if has_indRefMatch:
-                    d["indRef"] = lIndRef
-                    processed[indRef] = p.sub("N", str(lIndRef))
-
-                if has_indAltMatch:
-                    d["indAlt"] = lIndAlt                
-                    processed[indAlt] = p.sub("N", str(lIndAlt))
-
-                replacement_dict[line_number] = d
-                replacements += len(d)
-
-        outputfp.write("\t".join(processed) + "\n")
-
-with open("stats.json", "w+") as stats:
+        processed = line.rstrip(b"\n\r").split(b"\t")
+        indRef = processed.index(b"REF")
+        indAlt = processed.index(b"ALT")
+        outputfp.write(b"\t".join(processed) + b"\n")
+        break
+
+    # Trim the records, in blocks. These are bgzipped with the trimming,
+    # unless the records are indexed as they are written
+    compress = isinstance(outputfp, BgzfWriter) and not args.index
+    write = outputfp.write_blocks if compress else outputfp.write
+    jobs = ((block, first_line, indRef, indAlt, compress) for block, first_line
+            in read_blocks(inputfp, line_number + 1))
+    for trimmed, log, codes, contigs in trimmed_blocks(jobs, args.threads):
+        write(trimmed)
+        logfp.write(log)
+        code_counts.update(codes)
+        contig_counts.update(contigs)
+
+replacements = sum(contig_counts.values())
+
+with open(statspath, "w+") as stats:
     json.dump({
         "total": replacements,
-        "replacements": replacement_dict
+        "codes": code_counts,
+        "contigs": contig_counts,
+        "log": logpath
     }, stats)
 
@@ -1,5 +1,13 @@
+import re
+import sys
 from collections import OrderedDict
 from statistics import mean, stdev
+from pileup import tokenize_pileup
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 BAM_STATS_LINES = ['##FORMAT=<ID=PMCDP,Number=1,Type=Integer,Description="Total \
@@ -27,6 +35,8 @@ Bioinformatics Dept">\n',
 indicating if variant is bidirectional (N/A if no alt reads) - Calculated By \
 Bioinformatics Dept">\n']
 
+BAM_STATS_NAMES = ["PMCDP", "PMCRD", "PMCAD", "PMCFREQ", "PMCRDF", "PMCRDR",
+                   "PMCADF", "PMCADR", "PMCBDIR"]
 
 ###############################################################################
 
@@ -74,13 +84,133 @@ def cal_DP(DP):
 
     return col_mean, col_sd
 
+
+def cal_stats(name, values):
+    """Calculate the average and sd of AD (or DP) for a block of variants at
+    once, as cal_AD (cal_DP) does for each of them. With NumPy, the values
+    of all the variants and alleles are summed together, and the variance is
+    taken from the exact integer sums
+    Input: name, AD or DP
+           values, the AD (DP) of each caller, for each variant
+    Output: (mean, sd) for each variant
+    """
+    missing = '.,.' if name == 'AD' else '.'
+    if np is None:
+        cal = cal_AD if name == 'AD' else cal_DP
+        return [cal(vals) for vals in values]
+    # The values of each caller, and the variant they belong to
+    texts, entries = [], []
+    for i, vals in enumerate(values):
+        for val in vals:
+            if val != '.':
+                texts.append(val)
+                entries.append(i)
+    if not texts:
+        return [(missing, missing)] * len(values)
+    entries = np.array(entries, dtype=np.int64)
+    lengths = np.array([text.count(',') + 1 for text in texts],
+                       dtype=np.int64)
+    callers = np.bincount(entries, minlength=len(values))
+    # As zip, only the alleles given by all the callers of a variant are used
+    present = np.flatnonzero(callers)
+    alleles = np.zeros(len(values), dtype=np.int64)
+    alleles[present] = np.minimum.reduceat(
+        lengths, (np.cumsum(callers) - callers)[present])
+    offsets = np.cumsum(alleles) - alleles
+
+    # Sum the values of each (variant, allele), and their squares
+    ints = np.array(','.join(texts).split(','), dtype=np.int64)
+    allele = np.arange(len(ints)) - np.repeat(np.cumsum(lengths) - lengths,
+                                              lengths)
+    variant = np.repeat(entries, lengths)
+    used = allele < alleles[variant]
+    groups = (offsets[variant] + allele)[used]
+    ints = ints[used]
+    n = np.repeat(callers, alleles)
+    sums = np.bincount(groups, weights=ints,
+                       minlength=len(n)).astype(np.int64)
+    squares = np.bincount(groups, weights=ints * ints,
+                          minlength=len(n)).astype(np.int64)
+    means = np.rint(sums / n).tolist()
+    several = np.maximum(n, 2)
+    sds = np.sqrt((n * squares - sums * sums) /
+                  (several * (several - 1))).tolist()
+
+    stats = []
+    for count, start, end in zip(callers.tolist(), offsets.tolist(),
+                                 (offsets + alleles).tolist()):
+        if count == 0:
+            stats.append((missing, missing))
+            continue
+        col_mean = ','.join(str(int(i)) for i in means[start:end])
+        if count == 1:
+            stats.append((col_mean, missing))
+        else:
+            stats.append((col_mean, ','.join(str(round(i, 2))
+                                             for i in sds[start:end])))
+    return stats
+
 ###############################################################################
 
 
-class Variant:
+def split_info(info):
+    """Split the INFO column into {name: value}, flags have the name as value
+    """
+    info_dict = OrderedDict()
+    for i in info.split(';'):
+        try:
+            info_dict[i.split('=')[0]] = i.split('=')[1]
+        except:
+            info_dict[i] = i
+    return info_dict
+
+
+def info_pattern(names):
+    """Compile a pattern matching the INFO items with the given names, so
+    that only the selected columns are pulled out of the INFO string
+    """
+    names = sorted(set(names), key=len, reverse=True)
+    if not names:
+        # Nothing is selected, never match
+        return re.compile(r'(?!)')
+    return re.compile(r'(?:^|;)(' + '|'.join(re.escape(i) for i in names) +
+                      r')(?:=([^;=]*)[^;]*)?(?=;|$)')
+
+
+def scan_info(info, pattern):
+    """Pull the items matched by info_pattern out of the INFO column
+    Output: {name: value} of the matched items, flags have the name as value
+    """
+    info_dict = {}
+    for match in pattern.finditer(info):
+        name, val = match.groups()
+        info_dict[name] = name if val is None else val
+    return info_dict
+
+
+def split_format(format_):
+    """Split the raw (FORMAT, sample) or (FORMAT, normal, tumor) columns
     """
+    names = format_[0].split(':')
+    if len(format_) == 2:
+        return OrderedDict(zip(names, format_[1].split(':')))
+    format_dict = OrderedDict()
+    format_dict['normal'] = OrderedDict(zip(names, format_[1].split(':')))
+    format_dict['tumor'] = OrderedDict(zip(names, format_[2].split(':')))
+    return format_dict
+
+###############################################################################
+
+
+class Variant:
+    """A variant record. The INFO and FORMAT columns are kept as the raw
+    strings, and only split into dictionaries when they are read
     """
 
+    __slots__ = ('chr', 'pos', 'sample_id', 'ref', 'alt', 'qual', 'filter',
+                 'variant_key', '_info', '_info_raw', '_info_updates',
+                 '_format', '_format_raw')
+
     def __init__(self):
         """
         """
@@ -91,29 +221,74 @@ class Variant:
         self.sample_id = ''
         self.qual = ''
         self.filter = ''
-        self.mandatory = []
-        self.info, self.format = OrderedDict(), OrderedDict()
+        self.variant_key = None
+        self._info, self._format = OrderedDict(), OrderedDict()
+        self._info_raw, self._format_raw = None, None
+        self._info_updates = None
+
+    @property
+    def info(self):
+        """INFO as {name: value}, split from the raw column on first use
+        """
+        if self._info is None:
+            self._info = split_info(self._info_raw)
+            if self._info_updates:
+                self._info.update(self._info_updates)
+            self._info_raw, self._info_updates = None, None
+        return self._info
+
+    @info.setter
+    def info(self, info):
+        self._info, self._info_raw, self._info_updates = info, None, None
+
+    @property
+    def format(self):
+        """FORMAT as {name: value} (or {'normal': {}, 'tumor': {}} if somatic),
+        split from the raw columns on first use
+        """
+        if self._format is None:
+            self._format = split_format(self._format_raw)
+            self._format_raw = None
+        return self._format
 
-    def process_variant(self, line, caller):
-        """Create variant from line (with processing of GT and AF)
+    @format.setter
+    def format(self, format_):
+        self._format, self._format_raw = format_, None
+
+    def set_info(self, name, val):
+        """Set a value in INFO, without splitting the column
+        """
+        if self._info is None:
+            if self._info_updates is None:
+                self._info_updates = OrderedDict()
+            self._info_updates[name] = val
+        else:
+            self._info[name] = val
+
+    def _read_line(self, line, columns=-1):
+        """Read the mandatory columns, keep INFO as the raw string
+        Only the first columns are split, the rest of the line (e.g. the
+        other samples) is left in the last item
         """
-        line = line.strip().split('\t')
-        self.chr = line[0]
+        line = line.rstrip().split('\t', columns)
+        # The contig and alleles are interned, so they are shared by all the
+        # records (and keys) instead of being copied for each one
+        self.chr = sys.intern(line[0])
         self.pos = line[1]
         self.sample_id = line[2]
-        self.ref = line[3]
-        self.alt = line[4]
+        self.ref = sys.intern(line[3])
+        self.alt = sys.intern(line[4])
         self.qual = line[5]
         self.filter = line[6]
-        self.mandatory = line[:7]
-        self.variant_key = '\t'.join(line[:2] + line[3:5])
-        for i in line[7].split(';'):
-            try:
-                self.info[i.split('=')[0]] = i.split('=')[1]
-            except:
-                self.info[i] = i
-        for name, val in zip(line[8].split(':'), line[9].split(':')):
-            self.format[name] = val
+        self.variant_key = (self.chr, int(self.pos), self.ref, self.alt)
+        self._info, self._info_raw = None, line[7]
+        return line
+
+    def process_variant(self, line, caller):
+        """Create variant from line (with processing of GT and AF)
+        """
+        line = self._read_line(line, 10)
+        self._format, self._format_raw = None, (line[8], line[9])
 
         # Normalise GT
         self.format['GT'] = normalise_GT(self.format['GT'])
@@ -126,105 +301,81 @@ class Variant:
 
         # Calculate the allele frequency regardless
         try:
-            self.info['AF'] = str(round(float(self.format['AD'].split(',')
-                                  [1]) / float(self.format['DP']), 2))
+            self.set_info('AF', str(round(float(self.format['AD'].split(',')
+                                      [1]) / float(self.format['DP']), 2)))
         except:
-            self.info['AF'] = '.'
+            self.set_info('AF', '.')
 
         # Replace the AD / DP values in INFO with FORMAT
         if 'AD' in self.format.keys():
-            self.info['AD'] = self.format['AD']
+            self.set_info('AD', self.format['AD'])
         if 'DP' in self.format.keys():
-            self.info['DP'] = self.format['DP']
+            self.set_info('DP', self.format['DP'])
         return self
 
     def process_somatic_variant(self, line, caller, n_index, t_index):
         """Create somatic variant from line (with normalisation of GT)
         """
 
-        line = line.strip().split('\t')
-        self.chr = line[0]
-        self.pos = line[1]
-        self.sample_id = line[2]
-        self.ref = line[3]
-        self.alt = line[4]
-        self.qual = line[5]
-        self.filter = line[6]
-        self.mandatory = line[:7]
-        self.variant_key = '\t'.join(line[:2] + line[3:5])
-        normal_dict, tumor_dict = OrderedDict(), OrderedDict()
-
-        # Prevent the single tag situation, like "SOMATIC;" (in strelka)
-        for i in line[7].split(';'):
-            try:
-                self.info[i.split('=')[0]] = i.split('=')[1]
-            except:
-                self.info[i] = i
-        for name, val in zip(line[8].split(':'), line[n_index].split(':')):
-            normal_dict[name] = val
-        for name, val in zip(line[8].split(':'), line[t_index].split(':')):
-            tumor_dict[name] = val
+        line = self._read_line(line, max(n_index, t_index) + 1)
+        self._format = None
+        self._format_raw = (line[8], line[n_index], line[t_index])
 
         # Normalise GT (no GT in strelka)
         if caller == 'strelka':
             pass
         else:
-            normal_dict['GT'] = normalise_GT(normal_dict['GT'])
-            tumor_dict['GT'] = normalise_GT(tumor_dict['GT'])
-
-        # self.foramt would be a dict containing two dicts, normal and tumor
-        self.format['normal'] = normal_dict
-        self.format['tumor'] = tumor_dict
+            self.format['normal']['GT'] = normalise_GT(
+                self.format['normal']['GT'])
+            self.format['tumor']['GT'] = normalise_GT(
+                self.format['tumor']['GT'])
 
         return self
 
-    def read_variant(self, line, somatic=False, normal=None, tumor=None):
+    def read_variant(self, line, somatic=False, normal=None, tumor=None,
+                     samples=False):
         """Create variant from line (no processing)
+        With samples, all the sample columns are kept (see
+        add_samples_bam_stats)
         """
 
-        line = line.strip().split('\t')
-        self.chr = line[0]
-        self.pos = line[1]
-        self.sample_id = line[2]
-        self.ref = line[3]
-        self.alt = line[4]
-        self.qual = line[5]
-        self.filter = line[6]
-        self.mandatory = line[:7]
-        self.variant_key = '\t'.join(line[:2] + line[3:5])
-
-        for i in line[7].split(';'):
-            try:
-                self.info[i.split('=')[0]] = i.split('=')[1]
-            except:
-                self.info[i] = i
-
-        if not somatic:
-            for name, val in zip(line[8].split(':'), line[9].split(':')):
-                self.format[name] = val
+        if samples:
+            line = self._read_line(line)
+        elif not somatic:
+            line = self._read_line(line, 10)
+        else:
+            line = self._read_line(line, max(normal, tumor) + 1)
+        self._format = None
+        if samples:
+            self._format_raw = tuple(line[8:])
+        elif not somatic:
+            self._format_raw = (line[8], line[9])
         else:
-            normal_dict, tumor_dict = OrderedDict(), OrderedDict()
-            for name, val in zip(line[8].split(':'), line[normal].split(':')):
-                normal_dict[name] = val
-            for name, val in zip(line[8].split(':'), line[tumor].split(':')):
-                tumor_dict[name] = val
-            self.format['normal'] = normal_dict
-            self.format['tumor'] = tumor_dict
+            self._format_raw = (line[8], line[normal], line[tumor])
 
         return self
 
-    def select_info(self, i_dict, f_dict, caller=None, somatic=False):
+    def select_info(self, i_dict, f_dict, caller=None, somatic=False,
+                    pattern=None):
         """ Update the variant with the selected columns
         Input:
             new info, format dictionary {col: header object}
+            pattern, info_pattern of the i_dict columns. If given, only the
+            selected items are pulled out of INFO, instead of splitting it
         Output:
             updated variant with selected info/format values
         """
         new_info, new_format = OrderedDict(), OrderedDict()
+        if pattern is not None and self._info is None:
+            old_info = scan_info(self._info_raw, pattern)
+            if self._info_updates:
+                old_info.update(self._info_updates)
+        else:
+            old_info = self.info
 
         if not somatic:
             for k, v in i_dict.items():
-                info = self.info.get(k, '.')
+                info = old_info.get(k, '.')
                 if info:
                     new_info[v.meta_id] = info
                 else:
@@ -236,10 +387,11 @@ class Variant:
             new_format['normal'], new_format['tumor'] = OrderedDict(),\
                                                         OrderedDict()
             for k, v in i_dict.items():
-                try:
-                    # Try if k is a normal column in INFO:
-                    new_info[k] = self.info[k]
-                except KeyError:
+                info = old_info.get(k)
+                if info is not None:
+                    # k is a normal column in INFO
+                    new_info[k] = info
+                else:
                     # This column has normal / tumor
                     try:
                         if k.endswith('normal'):
@@ -266,12 +418,75 @@ class Variant:
 
         return self
 
-    def combine_info(self, cols, callers, i_dict, somatic=False):
+    def record(self, names, somatic=False):
+        """Compact tuple of a variant with its selected columns (after
+        select_info), quick to pickle between processes (see from_record)
+        Input: names, {names: names} shared by the records of a vcf, so the
+               same INFO / FORMAT names are only pickled once
+        """
+        def shared(keys):
+            keys = tuple(keys)
+            return names.setdefault(keys, keys)
+        if not somatic:
+            format_names = shared(self.format)
+            format_vals = tuple(self.format.values())
+        else:
+            format_names = (shared(self.format['normal']),
+                            shared(self.format['tumor']))
+            format_vals = (tuple(self.format['normal'].values()),
+                           tuple(self.format['tumor'].values()))
+        return (self.chr, self.pos, self.sample_id, self.ref, self.alt,
+                self.qual, self.filter, shared(self.info),
+                tuple(self.info.values()), format_names, format_vals)
+
+    @classmethod
+    def from_record(cls, record, somatic=False):
+        """Variant from its compact tuple (see record)
+        """
+        (chr_, pos, sample_id, ref, alt, qual, filter_, info_names, info_vals,
+         format_names, format_vals) = record
+        variant = cls()
+        variant.chr = sys.intern(chr_)
+        variant.pos = pos
+        variant.sample_id = sample_id
+        variant.ref = sys.intern(ref)
+        variant.alt = sys.intern(alt)
+        variant.qual = qual
+        variant.filter = filter_
+        variant.variant_key = (variant.chr, int(pos), variant.ref, variant.alt)
+        variant.info = OrderedDict(zip(info_names, info_vals))
+        if not somatic:
+            variant.format = OrderedDict(zip(format_names, format_vals))
+        else:
+            variant.format = OrderedDict(
+                (sample, OrderedDict(zip(sample_names, sample_vals)))
+                for sample, sample_names, sample_vals in zip(
+                    ('normal', 'tumor'), format_names, format_vals))
+        return variant
+
+    def stats_values(self, cols, i_dict, somatic=False):
+        """ Find the AD / DP values of each caller, to calculate their mean
+        and sd
+        Input: a list of columns to keep
+               a dictionary with combined info columns
+        Output: {name: list of values}, the names are AD / DP (AD_normal,
+                DP_normal, AD_tumor, DP_tumor if somatic)
+        """
+        names = [name for name in ['AD', 'DP'] if name in cols]
+        if somatic:
+            names = [name + '_' + i for i in ['normal', 'tumor']
+                     for name in names]
+        return OrderedDict((name, [v for k, v in i_dict.items()
+                                   if k.startswith(name)]) for name in names)
+
+    def combine_info(self, cols, callers, i_dict, somatic=False, stats=None):
         """ Combine the information, and calculate the mean, sd of AD / DP
         if specified.
         Input: a variant object (the first occurance in the vcfs)
                a list of columns to keep
                a dictionary with combined info columns
+               the (mean, sd) of stats_values, if calculated for a block of
+               variants (see cal_stats)
         Output: a new variant object
         """
         self.info = i_dict
@@ -279,36 +494,20 @@ class Variant:
         new_info_vals = ['-'.join(callers)]
 
         # Calculate AD and DP
-        if not somatic:
-            if 'AD' in cols:
-                AD = [v for k, v in i_dict.items() if k.startswith('AD')]
-                col_mean, col_sd = cal_AD(AD)
-                new_info_names.extend(['AD_mean', 'AD_sd'])
-                new_info_vals.extend([col_mean, col_sd])
-                self.format['AD'] = col_mean
-
-            if 'DP' in cols:
-                DP = [v for k, v in i_dict.items() if k.startswith('DP')]
-                #print(DP)
-                col_mean, col_sd = cal_DP(DP)
-                new_info_names.extend(['DP_mean', 'DP_sd'])
-                new_info_vals.extend([col_mean, col_sd])
-                self.format['DP'] = col_mean
-
-        else:
-            for i in ['normal', 'tumor']:
-                if 'AD' in cols:
-                    AD = [v for k, v in i_dict.items() if k.startswith('AD_' + i)]
-                    col_mean, col_sd = cal_AD(AD)
-                    new_info_names.extend(['AD_mean_'+i, 'AD_sd_'+i])
-                    new_info_vals.extend([col_mean, col_sd])
-                    self.format[i]['AD'] = col_mean
-                if 'DP' in cols:
-                    DP = [v for k, v in i_dict.items() if k.startswith('DP_' + i)]
-                    col_mean, col_sd = cal_DP(DP)
-                    new_info_names.extend(['DP_mean_'+i, 'DP_sd_'+i])
-                    new_info_vals.extend([col_mean, col_sd])
-                    self.format[i]['DP'] = col_mean                
+        values = self.stats_values(cols, i_dict, somatic)
+        if stats is None:
+            stats = {name: cal_AD(vals) if name.startswith('AD')
+                     else cal_DP(vals) for name, vals in values.items()}
+        for name in values:
+            col_mean, col_sd = stats[name]
+            if not somatic:
+                new_info_names.extend([name + '_mean', name + '_sd'])
+                self.format[name] = col_mean
+            else:
+                name, i = name.split('_')
+                new_info_names.extend([name + '_mean_' + i, name + '_sd_' + i])
+                self.format[i][name] = col_mean
+            new_info_vals.extend([col_mean, col_sd])
 
         # Remove the '.' from AD/DP/AF
         new_info = OrderedDict()
@@ -325,64 +524,54 @@ class Variant:
         self.filter = '.'
         return self
 
-    def cal_bam_stats(self, pileup_line):
+    def cal_bam_stats(self, pileup_line, tokens=None):
         """Calculate the bam stats from the pileup line
+        Input: the tokens of the pileup if already tokenized (by
+               tokenize_pileups)
         """
         if pileup_line:
 
-            pileup = pileup_line[1]
+            # The start/end of reads and indels are tokenized in one pass
+            if tokens is None:
+                tokens = tokenize_pileup(pileup_line[1])
+            bases, counts, indels = tokens
             total_depth = int(pileup_line[0])
-            ref_fwd = pileup.count('.')
-            ref_rev = pileup.count(',')
-
-            # SNV
-            if len(self.ref) == len(self.alt):
-
-                # Recursively remove the indels to avoid counting the indels
-                while '-' in pileup:
-                    index = pileup.index('-')
-                    # check length of indel, which may be multiple characters (>=10)
-                    i=1
-                    length=""
-                    while pileup[index+i] in [str(x) for x in range(0,10)]:
-                        length += pileup[index+i]
-                        i+=1
-                    length = int(length)
-                    pileup = pileup[:index] + pileup[index+length+i:]
-                while '+' in pileup:
-                    index = pileup.index('+')
-                    i=1
-                    length=""
-                    while pileup[index+i] in [str(x) for x in range(0,10)]:
-                        length += pileup[index+i]
-                        i+=1
-                    length = int(length)
-                    pileup = pileup[:index] + pileup[index+length+i:]
-                alt_fwd = pileup.count(self.alt)
-                alt_rev = pileup.count(self.alt.lower())
+            ref_fwd = counts['.']
+            ref_rev = counts[',']
+
+            # SNV (the indels are not counted as bases)
+            if len(self.ref) == len(self.alt) == 1:
+                alt_fwd = counts[self.alt]
+                alt_rev = counts[self.alt.lower()]
+
+            # MNP (and SNV written with a longer REF/ALT)
+            elif len(self.ref) == len(self.alt):
+                if bases is None:
+                    bases = tokenize_pileup(pileup_line[1])[0]
+                alt_fwd = bases.count(self.alt)
+                alt_rev = bases.count(self.alt.lower())
 
             # Insertion, eg. ref 'C' alt 'CCA'
             elif len(self.ref) == 1 and len(self.alt) > 1:
 
                 # Look for the pattern +2CA/+2ca (+, length of insertion, bases)
-                alt_fwd = pileup.count('+' + str(len(self.alt[1:])) + self.alt[1:])
-                alt_rev = pileup.count('+' + str(len(self.alt[1:])) +
-                                       self.alt[1:].lower())
+                alt_fwd = indels['+' + str(len(self.alt[1:])) + self.alt[1:]]
+                alt_rev = indels['+' + str(len(self.alt[1:])) +
+                                 self.alt[1:].lower()]
                 # Recalcualte the reference supporting reads (pileup report the
                 # reference match followed by indels)
                 ref_fwd -= alt_fwd
                 ref_rev -= alt_rev
 
             elif len(self.ref) > 1 and len(self.alt) == 1:
-                alt_fwd = pileup.count('-' + str(len(self.ref[1:])) +
-                                       self.ref[1:])
-                alt_rev = pileup.count('-' + str(len(self.ref[1:])) +
-                                       self.ref[1:].lower())
+                alt_fwd = indels['-' + str(len(self.ref[1:])) + self.ref[1:]]
+                alt_rev = indels['-' + str(len(self.ref[1:])) +
+                                 self.ref[1:].lower()]
                 ref_fwd -= alt_fwd
                 ref_rev -= alt_rev
 
             else:
-                # The MNP and other werid variants
+                # Other werid variants (e.g. complex indels)
                 alt_fwd, alt_rev = 0, 0
 
             ref_reads = ref_fwd + ref_rev
@@ -410,8 +599,7 @@ class Variant:
         """Calculate the bam stats for the variant
         """
         # Add the values to format
-        new_format = ["PMCDP", "PMCRD", "PMCAD", "PMCFREQ", "PMCRDF", "PMCRDR",
-                      "PMCADF", "PMCADR", "PMCBDIR"]
+        new_format = BAM_STATS_NAMES
         if not somatic:
             for name, val in zip(new_format, bam_stats):
                 self.format[name] = str(val)
@@ -422,16 +610,48 @@ class Variant:
                 self.format['tumor'][name] = str(val)
         return self
 
+    def add_samples_bam_stats(self, bam_stats):
+        """Add the bam stats to the FORMAT of the sample columns, which are
+        kept as the raw strings (the variant is read with samples=True)
+        Input: bam stats of each sample column, None for the samples that are
+               not annotated (their trailing fields are left out)
+        """
+        names = self._format_raw[0].split(':')
+        columns = [':'.join(names + BAM_STATS_NAMES)]
+        for sample, stats in zip(self._format_raw[1:], bam_stats):
+            if stats is None:
+                columns.append(sample)
+                continue
+            # Pad the trailing fields left out of the sample, so the bam
+            # stats line up with their names
+            vals = sample.split(':')
+            vals.extend(['.'] * (len(names) - len(vals)))
+            columns.append(':'.join(vals + [str(val) for val in stats]))
+        self._format_raw = tuple(columns)
+        return self
+
     def write(self, somatic=False):
         """Write modified variant line
         """
-        if not somatic:
-            info_, format_names, format_vals = [], [], []
+        # INFO / FORMAT that were never split are written back as read
+        if self._info is None and not self._info_updates:
+            info_ = [self._info_raw]
+        else:
+            info_ = []
             for name, val in self.info.items():
                 if name == val:
                     info_.append(name)
                 else:
                     info_.append('='.join([name, val]))
+
+        if self._format is None:
+            return ('\t'.join([self.chr, self.pos, self.sample_id,
+                               self.ref, self.alt, self.qual, self.filter] +
+                              [';'.join(info_)] + list(self._format_raw)) +
+                    '\n')
+
+        if not somatic:
+            format_names, format_vals = [], []
             for name, val in self.format.items():
                 format_names.append(name)
                 format_vals.append(val)
@@ -441,13 +661,7 @@ class Variant:
                                ':'.join(format_vals)]) + '\n')
 
         else:
-            info_, format_names, normal_format_vals, tumor_format_vals =\
-                [], [], [], []
-            for name, val in self.info.items():
-                if name == val:
-                    info_.append(name)
-                else:
-                    info_.append('='.join([name, val]))
+            format_names, normal_format_vals, tumor_format_vals = [], [], []
             for name, val in self.format['normal'].items():
                 format_names.append(name)
                 normal_format_vals.append(val)
@@ -458,4 +672,3 @@ class Variant:
                               [';'.join(info_), ':'.join(format_names), 
                                ':'.join(normal_format_vals), 
                                ':'.join(tumor_format_vals)]) + '\n')
-
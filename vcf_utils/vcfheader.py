@@ -1,6 +1,7 @@
 import re
 import copy
 from collections import OrderedDict
+from functools import lru_cache
 
 
 GT_LINE = '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">'
@@ -41,6 +42,12 @@ Description="Mean of allelic depths in source vcfs">\n',
                         '##FORMAT=<ID=DP,Number=1,Type=Float, \
 Description="Mean of read depths in source vcfs">\n']
 HEADER = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT'
+# ##META=<key=value,key="quoted, value",...>
+META_LINE = re.compile(r'##([^=]*)=<(.*)>')
+META_ITEM = re.compile(r'\s*([^=,]+)=("(?:[^"\\]|\\.)*"|[^,]*),?')
+# Number of parsed meta information lines kept, enough for the INFO/FORMAT
+# lines of heavily annotated vcfs
+HEADER_CACHE_SIZE = 16384
 
 #####################################################################
 
@@ -105,6 +112,100 @@ def extract_cols_somatic(i_dict, f_dict, cols):
         f_cols.update({'GT': VcfHeader(GT_LINE)})
     return i_cols, f_cols
 
+def contig_id(line):
+    """Get the ID from a ##contig=<ID=...> line
+    """
+    for i in line.strip()[len('##contig=<'):-1].split(','):
+        if i.startswith('ID='):
+            return i[len('ID='):]
+    return None
+
+
+class ContigOrder:
+    """Rank of the contigs, in the order of the ##contig lines. Contigs
+    missing from the header are ranked after, in the order they are first seen
+    """
+
+    def __init__(self, contigs=()):
+        self.rank = {}
+        for contig in contigs:
+            self.index(contig)
+
+    def index(self, contig):
+        """Return the rank of the contig (adding it if new)
+        """
+        try:
+            return self.rank[contig]
+        except KeyError:
+            self.rank[contig] = len(self.rank)
+            return self.rank[contig]
+
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def parse_meta(line):
+    """Parse a ##INFO/##FORMAT... meta information line. The values can be
+    quoted (with commas, '<' or '>' inside). The result is cached, as the
+    same lines are repeated in the vcfs of each caller
+    Output: (meta, ID, Number, Type, Description), None if missing (an
+            empty Description)
+    """
+    match = META_LINE.match(line.strip())
+    if match is None:
+        raise ValueError('Invalid meta information line: {}'.format(line))
+    items = {key: val[1:-1] if val.startswith('"') else val
+             for key, val in META_ITEM.findall(match.group(2))}
+    return (match.group(1), items.get('ID'), items.get('Number'),
+            items.get('Type'), items.get('Description', ''))
+
+
+def meta_key(line):
+    """Key of a meta information line: (meta, ID) if it is a structured line
+    with an ID (e.g. ##contig=<ID=chr1,...>), the line itself otherwise
+    """
+    if line.startswith('##fileformat='):
+        # Only one per vcf
+        return 'fileformat', None
+    if META_LINE.match(line.strip()):
+        meta, meta_id = parse_meta(line)[:2]
+        if meta_id is not None:
+            return meta, meta_id
+    return line
+
+
+class MetaInfo:
+    """Meta information lines of the vcfs merged together, indexed by
+    (meta, ID). A line is kept once (the first seen) even if it is written
+    differently in each vcf, the lines without an ID are kept once each
+    """
+
+    def __init__(self, lines=()):
+        self.lines = OrderedDict()
+        self.update(lines)
+
+    def update(self, lines):
+        """Add the lines not in the header yet
+        """
+        for line in lines:
+            self.lines.setdefault(meta_key(line), line)
+
+    def get(self, meta, meta_id):
+        """Return the line of the ID (e.g. 'INFO', 'DP'), None if missing
+        """
+        return self.lines.get((meta, meta_id))
+
+    def contig_order(self):
+        """ContigOrder of the ##contig lines
+        """
+        return ContigOrder(key[1] for key in self.lines
+                           if isinstance(key, tuple) and key[0] == 'contig')
+
+    def write(self, f):
+        """Write the lines, in the order they were first seen
+        """
+        for line in self.lines.values():
+            f.write(line)
+
+
 #####################################################################
 
 
@@ -116,16 +217,8 @@ class VcfHeader:
         """Create object from the meta informaiton line
         """
 
-        line = re.split('<|>|"', line)
-        h_dict = {}
-        for i in re.split(',(?!\s)', line[1]):
-            h_dict.update({i.split('=')[0]: i.split('=')[1]})
-
-        self.meta = line[0][:-1].replace('#', '')
-        self.meta_id = h_dict.get('ID', None)
-        self.meta_number = h_dict.get('Number', None)
-        self.meta_type = h_dict.get('Type', None)
-        self.meta_description = line[2]
+        (self.meta, self.meta_id, self.meta_number, self.meta_type,
+         self.meta_description) = parse_meta(line)
         self.normal_tumor = False
 
     def add_caller(self, caller):
@@ -0,0 +1,581 @@
+import io
+import os
+import re
+import sys
+import gzip
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+
+##############################################################################
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Maximum uncompressed size of a BGZF block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b00030000000000'
+                         '00000000')
+# Size of the decompressed chunks passed from the reading thread
+CHUNK_SIZE = 1 << 20
+QUEUE_SIZE = 8
+INDEX_FORMATS = ['tbi', 'csi']
+# End of a region without an end position
+MAX_POS = 1 << 62
+# Binning scheme of the tabix index: 16kb windows, 5 levels (up to 512Mb)
+MIN_SHIFT, DEPTH = 14, 5
+TBX_VCF = 2
+# start or start-end of a region, after the contig
+REGION_RANGE = re.compile(r'^([\d,]+)(?:-([\d,]+))?$')
+
+##############################################################################
+
+
+def is_gzip(path):
+    """Check whether the file is gzip (or BGZF) compressed
+    """
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_vcf(path, mode='r', index=None):
+    """Open a vcf as text (or as bytes with mode 'rb' / 'wb')
+    Reading: plain text, or gzip/BGZF (decompressed in a background thread).
+             '-' reads stdin (which can be compressed too)
+    Writing: BGZF if the path ends with '.gz', with a tabix (tbi) or csi index
+             if index is given. '-' writes stdout
+    """
+    if mode in ('r', 'rb'):
+        if path == '-':
+            # A reader of its own, so sys.stdin is not locked by the reading
+            # thread when worker processes are forked (they close sys.stdin)
+            stdin = open(sys.stdin.fileno(), 'rb', closefd=False)
+            if stdin.peek(2)[:2] == GZIP_MAGIC:
+                stdin = io.BufferedReader(ThreadedGzipReader(stdin),
+                                          CHUNK_SIZE)
+            return stdin if mode == 'rb' else io.TextIOWrapper(stdin)
+        if is_gzip(path):
+            f = io.BufferedReader(ThreadedGzipReader(path), CHUNK_SIZE)
+            return f if mode == 'rb' else io.TextIOWrapper(f)
+        return open(path, mode)
+
+    if path == '-':
+        return sys.stdout.buffer if mode == 'wb' else sys.stdout
+    if path.endswith('.gz'):
+        return BgzfWriter(path, index=index)
+    if index:
+        sys.exit('Only bgzipped vcfs (ending with .gz) can be indexed: {}'
+                 .format(path))
+    return open(path, mode)
+
+##############################################################################
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    """Binary stream of a gzip file, decompressed in a background thread so
+    that the decompression overlaps with the parsing of the lines
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.name = path
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._decompress,
+                                        args=(path, chunk_size), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, path, chunk_size):
+        try:
+            with gzip.open(path, 'rb') as f:
+                while not self._stop.is_set():
+                    chunk = f.read(chunk_size)
+                    self._put(chunk)
+                    if not chunk:
+                        break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._chunk:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+##############################################################################
+
+
+def reg2bin(beg, end, min_shift=MIN_SHIFT, depth=DEPTH):
+    """Smallest bin containing [beg, end) (0-based), as in the SAM spec
+    """
+    end -= 1
+    level, shift = depth, min_shift
+    t = ((1 << depth * 3) - 1) // 7
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return t + (beg >> shift)
+        level -= 1
+        shift += 3
+        t -= 1 << level * 3
+    return 0
+
+
+def bin_start(bin_, min_shift=MIN_SHIFT, depth=DEPTH):
+    """0-based start position of a bin
+    """
+    level, first = 0, 0
+    while bin_ >= first + (1 << level * 3):
+        first += 1 << level * 3
+        level += 1
+    return (bin_ - first) << (min_shift + 3 * (depth - level))
+
+
+def record_span(fields):
+    """0-based [beg, end) of a vcf record (END in INFO if given)
+    """
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    for i in fields[7].split(';'):
+        if i.startswith('END='):
+            try:
+                end = max(end, int(i[len('END='):]))
+            except ValueError:
+                pass
+    return beg, max(end, beg + 1)
+
+
+def reg2bins(beg, end, min_shift=MIN_SHIFT, depth=DEPTH):
+    """All the bins overlapping [beg, end) (0-based)
+    """
+    bins = []
+    end -= 1
+    t, shift = 0, min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(range(t + (beg >> shift), t + (end >> shift) + 1))
+        shift -= 3
+        t += 1 << level * 3
+    return bins
+
+
+def parse_region(region):
+    """Parse 'chr', 'chr:start' or 'chr:start-end' (1-based, inclusive). The
+    contig is before the last ':' only if a range follows it, so contig names
+    can have ':' in them (e.g. HLA-A*01:01:01:01:1-500). A name ending with
+    ':' and digits is written in braces: '{HLA-A*01:01}'
+    Output: (contig, beg, end), 0-based half-open
+    """
+    if region.startswith('{'):
+        contig, brace, rest = region[1:].partition('}')
+        match = REGION_RANGE.match(rest[1:]) if rest.startswith(':') else None
+        if not brace or (rest and match is None):
+            sys.exit('Cannot parse region {}'.format(region))
+    else:
+        contig, colon, rest = region.rpartition(':')
+        match = REGION_RANGE.match(rest) if colon else None
+        if match is None:
+            contig = region
+    if not contig:
+        sys.exit('Cannot parse region {}'.format(region))
+    start, end = match.groups() if match else (None, None)
+    beg = int(start.replace(',', '')) - 1 if start else 0
+    end = int(end.replace(',', '')) if end else MAX_POS
+    if beg < 0 or end <= beg:
+        sys.exit('Invalid region {}'.format(region))
+    return contig, beg, end
+
+
+def find_index(path):
+    """Path of the tbi/csi index of a bgzipped vcf, or None
+    """
+    for index_format in INDEX_FORMATS:
+        if os.path.exists('{}.{}'.format(path, index_format)):
+            return '{}.{}'.format(path, index_format)
+    return None
+
+
+def read_index(path):
+    """Read a tbi/csi index
+    Output: min_shift, depth, {contig: (bins {bin: chunks}, linear index)}
+    """
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+    magic = data[:4]
+    if magic == b'TBI\1':
+        min_shift, depth = MIN_SHIFT, DEPTH
+        n_ref, = struct.unpack_from('<i', data, 4)
+        aux_offset = 8
+    elif magic == b'CSI\1':
+        min_shift, depth, l_aux = struct.unpack_from('<3i', data, 4)
+        aux_offset = 16
+        n_ref, = struct.unpack_from('<i', data, aux_offset + l_aux)
+    else:
+        sys.exit('{} is not a tbi/csi index'.format(path))
+    l_nm, = struct.unpack_from('<i', data, aux_offset + 24)
+    names = data[aux_offset + 28:aux_offset + 28 + l_nm].split(b'\0')[:-1]
+    offset = aux_offset + 28 + l_nm if magic == b'TBI\1' else \
+        aux_offset + l_aux + 4
+
+    refs = {}
+    for name in names:
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        bins = {}
+        for i in range(n_bin):
+            bin_, = struct.unpack_from('<I', data, offset)
+            offset += 4 if magic == b'TBI\1' else 12
+            n_chunk, = struct.unpack_from('<i', data, offset)
+            offset += 4
+            bins[bin_] = [struct.unpack_from('<QQ', data, offset + 16 * j)
+                          for j in range(n_chunk)]
+            offset += 16 * n_chunk
+        linear = []
+        if magic == b'TBI\1':
+            n_intv, = struct.unpack_from('<i', data, offset)
+            linear = list(struct.unpack_from('<{}Q'.format(n_intv), data,
+                                             offset + 4))
+            offset += 4 + 8 * n_intv
+        refs[name.decode()] = (bins, linear)
+    return min_shift, depth, refs
+
+
+def read_bgzf(f, vbeg, vend):
+    """Yield the lines of a BGZF file between two virtual offsets
+    """
+    f.seek(vbeg >> 16)
+    skip, partial = vbeg & 0xffff, b''
+    while True:
+        block_offset = f.tell()
+        header = f.read(18)
+        if len(header) < 18:
+            break
+        bsize, = struct.unpack_from('<H', header, 16)
+        cdata = f.read(bsize - 25)
+        f.read(8)
+        data = zlib.decompress(cdata, -15)
+        if block_offset == vend >> 16:
+            data = data[:vend & 0xffff]
+        data, skip = data[skip:], 0
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line.decode() + '\n'
+        if block_offset >= vend >> 16:
+            break
+    if partial:
+        yield partial.decode() + '\n'
+
+
+def read_chunks(path, chunks):
+    """Yield the lines of the (virtual offset) chunks of a BGZF file
+    """
+    with open(path, 'rb') as f:
+        for vbeg, vend in chunks:
+            for line in read_bgzf(f, vbeg, vend):
+                yield line
+
+
+def fetch(path, region, vcf=None):
+    """Yield the vcf lines with POS in the region (contig, beg, end)
+    Uses the tbi/csi index of a bgzipped vcf if there is one, otherwise
+    filters the lines of vcf (open, and positioned after the header)
+    """
+    contig, beg, end = region
+    index = find_index(path) if is_gzip(path) else None
+    if index is None:
+        lines = vcf
+    else:
+        min_shift, depth, refs = read_index(index)
+        if contig not in refs:
+            return
+        bins, linear = refs[contig]
+        end = min(end, 1 << (min_shift + 3 * depth))
+        min_offset = linear[min(beg >> min_shift, len(linear) - 1)] \
+            if linear else 0
+        chunks = sorted(chunk for bin_ in reg2bins(beg, end, min_shift, depth)
+                        for chunk in bins.get(bin_, []) if chunk[1] > min_offset)
+        merged = []
+        for chunk in chunks:
+            if merged and chunk[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append(list(chunk))
+        lines = read_chunks(path, merged)
+    for line in lines:
+        fields = line.split('\t', 2)
+        if fields[0] == contig and beg < int(fields[1]) <= end:
+            yield line
+
+
+class VcfIndex:
+    """Build a tabix (tbi) or csi index of a sorted, bgzipped vcf
+    """
+
+    def __init__(self, index_format='tbi', depth=DEPTH):
+        self.format = index_format
+        self.depth = depth
+        self.names = []
+        # per contig: {bin: [[chunk begin, chunk end], ...]}, linear index,
+        # [first, last] virtual offsets and number of records
+        self.bins, self.linear, self.offsets, self.counts = [], [], [], []
+        self._last = None
+
+    def add(self, fields, vbeg, vend):
+        """Add a record with its virtual offsets (begin, end)
+        """
+        beg, end = record_span(fields)
+        contig = fields[0]
+        if not self.names or self.names[-1] != contig:
+            if contig in self.names:
+                sys.exit('The vcf is not sorted, cannot index contig {}'
+                         .format(contig))
+            self.names.append(contig)
+            self.bins.append({})
+            self.linear.append([])
+            self.offsets.append([vbeg, vend])
+            self.counts.append(0)
+        elif beg < self._last:
+            sys.exit('The vcf is not sorted, cannot index {}:{}'
+                     .format(contig, fields[1]))
+        if end > 1 << (MIN_SHIFT + 3 * self.depth):
+            sys.exit('Position {}:{} is too large for the index, use csi'
+                     .format(contig, end))
+        self._last = beg
+
+        chunks = self.bins[-1].setdefault(
+            reg2bin(beg, end, MIN_SHIFT, self.depth), [])
+        if chunks and chunks[-1][1] == vbeg:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vbeg, vend])
+        linear = self.linear[-1]
+        for window in range(beg >> MIN_SHIFT, ((end - 1) >> MIN_SHIFT) + 1):
+            if window >= len(linear):
+                linear.extend([0] * (window + 1 - len(linear)))
+            if linear[window] == 0:
+                linear[window] = vbeg
+        self.offsets[-1][1] = vend
+        self.counts[-1] += 1
+
+    def _tabix_header(self):
+        names = b''.join(name.encode() + b'\0' for name in self.names)
+        return (struct.pack('<6i', TBX_VCF, 1, 2, 0, ord('#'), 0) +
+                struct.pack('<i', len(names)) + names)
+
+    def _ref(self, i, with_loffset):
+        """Bins (and the linear index for tbi) of a contig
+        """
+        linear = self.linear[i]
+        # Empty windows take the offset of the previous window
+        for j in range(1, len(linear)):
+            if linear[j] == 0:
+                linear[j] = linear[j - 1]
+        bins = sorted(self.bins[i].items())
+        # Pseudo-bin with the offsets and number of records of the contig
+        pseudo = ((1 << (self.depth + 1) * 3) - 1) // 7 + 1
+        bins.append((pseudo, [self.offsets[i], [self.counts[i], 0]]))
+        data = [struct.pack('<i', len(bins))]
+        for bin_, chunks in bins:
+            data.append(struct.pack('<I', bin_))
+            if with_loffset:
+                window = bin_start(bin_, MIN_SHIFT, self.depth) >> MIN_SHIFT \
+                    if bin_ != pseudo else 0
+                loffset = linear[min(window, len(linear) - 1)] \
+                    if bin_ != pseudo else 0
+                data.append(struct.pack('<Q', loffset))
+            data.append(struct.pack('<i', len(chunks)))
+            for chunk in chunks:
+                data.append(struct.pack('<QQ', *chunk))
+        if not with_loffset:
+            data.append(struct.pack('<i', len(linear)))
+            data.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+        return b''.join(data)
+
+    def write(self, path):
+        """Write the (BGZF compressed) index
+        """
+        if self.format == 'tbi':
+            data = [b'TBI\1', struct.pack('<i', len(self.names)),
+                    self._tabix_header()]
+            data += [self._ref(i, False) for i in range(len(self.names))]
+        else:
+            aux = self._tabix_header()
+            data = [b'CSI\1', struct.pack('<3i', MIN_SHIFT, self.depth,
+                                          len(aux)), aux,
+                    struct.pack('<i', len(self.names))]
+            data += [self._ref(i, True) for i in range(len(self.names))]
+        with BgzfWriter(path) as f:
+            f.write_bytes(b''.join(data))
+
+
+def bgzf_block(data, level=6):
+    """Compress data (up to BGZF_BLOCK_SIZE bytes) into a BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord('B'), ord('C'), 2, len(cdata) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+
+def bgzf_compress(data, level=6):
+    """Compress data into BGZF blocks, without the EOF block (see
+    BgzfWriter.write_blocks)
+    """
+    return b''.join(bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level)
+                    for i in range(0, len(data), BGZF_BLOCK_SIZE))
+
+
+class BgzfWriter:
+    """Text (or bytes) file writing BGZF blocks, optionally indexing the vcf
+    records
+    """
+
+    def __init__(self, path, index=None, level=6):
+        self.name = path
+        self._f = open(path, 'wb')
+        self._level = level
+        self._buffer = bytearray()
+        self._partial = ''
+        self._block_offset = 0
+        self._index_format = index
+        self._index_path = '{}.{}'.format(path, index) if index else None
+        self._index = None
+        self._depth = DEPTH
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tell(self):
+        """Virtual offset of the next byte written
+        """
+        return (self._block_offset << 16) | len(self._buffer)
+
+    def _write_block(self, data):
+        block = bgzf_block(data, self._level)
+        self._f.write(block)
+        self._block_offset += len(block)
+
+    def write_blocks(self, blocks):
+        """Write data already compressed into BGZF blocks (by bgzf_compress,
+        e.g. in worker processes), after the data written so far. The
+        records written this way are not indexed
+        """
+        if self._index_path:
+            sys.exit('Cannot index the compressed blocks written to {}'
+                     .format(self.name))
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._f.write(blocks)
+        self._block_offset += len(blocks)
+
+    def write_bytes(self, data):
+        self._buffer += data
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            if not self._index_path:
+                self.write_bytes(text)
+                return len(text)
+            text = text.decode()
+        elif not self._index_path:
+            self.write_bytes(text.encode())
+            return len(text)
+        # Index the records, one line at a time
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if line.startswith('#'):
+                self.write_bytes(line.encode() + b'\n')
+                if not line.startswith('##'):
+                    self._index = VcfIndex(self._index_format, self._depth)
+                elif line.startswith('##contig='):
+                    self._contig(line)
+                continue
+            vbeg = self.tell()
+            self.write_bytes(line.encode() + b'\n')
+            self._index.add(line.split('\t', 8), vbeg, self.tell())
+        return len(text)
+
+    def _contig(self, line):
+        """Use a deeper csi binning if a contig is longer than 512Mb
+        """
+        for i in line.strip()[len('##contig=<'):-1].split(','):
+            if i.startswith('length=') and i[len('length='):].isdigit() and \
+               self._index_format == 'csi':
+                while int(i[len('length='):]) > \
+                        1 << (MIN_SHIFT + 3 * self._depth):
+                    self._depth += 1
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self._partial:
+            self.write('\n')
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._f.write(BGZF_EOF)
+        self._f.close()
+        self.closed = True
+        if self._index_path:
+            if self._index is None:
+                sys.exit('No header line in {}, cannot index'.format(self.name))
+            self._index.write(self._index_path)
+
+##############################################################################
+
+
+def ordered_map(pool, func, jobs, window):
+    """Like pool.map, but only submit window jobs ahead of the result being
+    yielded, so the results come back in order without reading all the jobs
+    (e.g. the blocks of a vcf being streamed)
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(func, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,47 @@
+import heapq
+import tempfile
+from itertools import islice
+
+##############################################################################
+
+# Number of vcf lines sorted in memory before spilling to a temporary file
+SORT_BUFFER = 1000000
+
+##############################################################################
+
+
+def vcf_sort_key(contig_order):
+    """Sort key of a vcf line: (contig rank, pos, ref, alt)
+    Input: ContigOrder, giving the rank of the contigs
+    """
+    def key(line):
+        line = line.split('\t', 5)
+        return (contig_order.index(line[0]), int(line[1]), line[3], line[4])
+    return key
+
+
+def sorted_lines(lines, key, buffer_size=SORT_BUFFER, tmp_dir=None):
+    """Sort the lines in memory, or if there are more than buffer_size lines,
+    sort them in chunks spilled to temporary files and merge the chunks
+    Output: generator of the sorted lines
+    """
+    lines = iter(lines)
+    chunk = sorted(islice(lines, buffer_size), key=key)
+    if len(chunk) < buffer_size:
+        for line in chunk:
+            yield line
+        return
+
+    spills = []
+    try:
+        while chunk:
+            spill = tempfile.TemporaryFile(mode='w+', dir=tmp_dir)
+            spill.writelines(chunk)
+            spill.seek(0)
+            spills.append(spill)
+            chunk = sorted(islice(lines, buffer_size), key=key)
+        for line in heapq.merge(*spills, key=key):
+            yield line
+    finally:
+        for spill in spills:
+            spill.close()
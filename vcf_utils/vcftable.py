@@ -0,0 +1,172 @@
+import sys
+from vcfheader import VcfHeader
+
+# pyarrow is only imported when a table is written (by check_pyarrow), so it
+# is not loaded by every run
+pa, pq = None, None
+
+##############################################################################
+
+# Number of variants written in each row group
+ROW_GROUP_SIZE = 100000
+# The vcf columns kept in the table, before the INFO fields
+VCF_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER']
+
+##############################################################################
+
+
+def check_pyarrow(path):
+    """Import pyarrow, needed to write the table, exit if it is not installed
+    """
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit('pyarrow is required to write {}'.format(path))
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def to_int(val):
+    """Integer value of a vcf field, None if missing (or not an integer)
+    """
+    try:
+        return int(val)
+    except ValueError:
+        return None
+
+
+def to_float(val):
+    """Float value of a vcf field, None if missing (or not a number)
+    """
+    try:
+        return float(val)
+    except ValueError:
+        return None
+
+
+def to_str(val):
+    """String value of a vcf field, None if missing
+    """
+    return None if val == '.' else val
+
+
+class InfoColumn:
+    """A typed column of the table, from the ##INFO line of the field
+    Attributes:
+    name: ID of the INFO field
+    flag: the field is a Flag (True if set, False otherwise)
+    single: the field has one value (Number=1), otherwise a list of values
+    """
+
+    def __init__(self, line):
+        header = VcfHeader(line)
+        self.name = header.meta_id
+        self.flag = header.meta_type == 'Flag'
+        self.single = header.meta_number == '1'
+        if header.meta_type == 'Integer':
+            arrow_type, self.convert = pa.int64(), to_int
+        elif header.meta_type == 'Float':
+            arrow_type, self.convert = pa.float64(), to_float
+        else:
+            arrow_type, self.convert = pa.string(), to_str
+        if self.flag:
+            arrow_type = pa.bool_()
+        elif not self.single:
+            arrow_type = pa.list_(arrow_type)
+        self.field = pa.field(self.name, arrow_type)
+
+    def value(self, val):
+        """Typed value of the field, from its raw INFO value (None if the
+        field is not in the record)
+        """
+        if self.flag:
+            # Flags are written as 'NAME' or 'NAME=NAME', and '.' if unset
+            return val is not None and val != '.'
+        if val is None:
+            return None
+        if self.single:
+            return self.convert(val)
+        if val == '.':
+            return None
+        return [self.convert(v) for v in val.split(',')]
+
+
+class VariantTable:
+    """Parquet table of the variants written to a vcf, one row per variant
+    with the vcf columns and a typed column for each INFO field (from the
+    ##INFO lines), written in row groups as the lines are given
+    Attributes:
+    vcf: the lines are also written to this file (if not None)
+    """
+
+    def __init__(self, path, vcf=None, row_group_size=ROW_GROUP_SIZE):
+        check_pyarrow(path)
+        self.name = path
+        self.vcf = vcf
+        self.row_group_size = row_group_size
+        self.columns = []
+        self._writer = None
+        self._rows = []
+
+    def write(self, line):
+        """Add a line of the vcf: the ##INFO lines give the columns, and each
+        variant line is a row
+        """
+        if self.vcf is not None:
+            self.vcf.write(line)
+        if line.startswith('##INFO='):
+            column = InfoColumn(line)
+            # Only the first line of a field is used
+            if all(column.name != c.name for c in self.columns):
+                self.columns.append(column)
+        elif line.startswith('#'):
+            pass
+        else:
+            self._rows.append(line)
+            if len(self._rows) == self.row_group_size:
+                self._write_rows()
+
+    def _write_rows(self):
+        """Convert the buffered lines into a row group
+        """
+        if self._writer is None:
+            fields = [pa.field(name, pa.string()) for name in VCF_COLUMNS]
+            fields[VCF_COLUMNS.index('POS')] = pa.field('POS', pa.int64())
+            fields[VCF_COLUMNS.index('QUAL')] = pa.field('QUAL', pa.float64())
+            self._schema = pa.schema(fields +
+                                     [column.field for column in self.columns])
+            self._writer = pq.ParquetWriter(self.name, self._schema)
+
+        values = [[] for _ in range(len(VCF_COLUMNS) + len(self.columns))]
+        for line in self._rows:
+            line = line.rstrip('\n').split('\t', 8)
+            for i, val in enumerate(line[:7]):
+                values[i].append(to_str(val))
+            values[1][-1] = int(line[1])
+            values[5][-1] = to_float(line[5])
+            info = {}
+            for field in line[7].split(';'):
+                name, _, val = field.partition('=')
+                info[name] = val or name
+            for i, column in enumerate(self.columns, len(VCF_COLUMNS)):
+                values[i].append(column.value(info.get(column.name)))
+        self._writer.write_table(pa.Table.from_arrays(
+            [pa.array(vals, type=field.type)
+             for vals, field in zip(values, self._schema)],
+            schema=self._schema))
+        self._rows = []
+
+    def close(self):
+        """Write the last row group, and close the table (not the vcf)
+        """
+        if self._rows or self._writer is None:
+            self._write_rows()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()